@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+### Copyright 1999-2024. Plesk International GmbH.
+
+###############################################################################
+# This script runs 360-phpfpm-plugin-conf.py end to end against synthetic
+# domains without touching the server: the Plesk CLI and systemctl are
+# replaced with stand-ins, the HTTPS probes of the domains are answered by a
+# local HTTP server and all the files the script works with are kept in a
+# temporary root.
+# Every run of the script is a process of its own. The bench reports the wall
+# time of every phase and the busy time of every stage of the pipeline from the
+# --timings report of the run, and the number of the spawned processes
+# Requirements : Python 3.x
+# Version      : 1.3
+#
+# Usage        : 360-phpfpm-plugin-conf-bench.py [--domains COUNT] [--latency MS]
+#                       [--php-update-latency MS] [--failure-rate RATE]
+#                       [--cloudflare-rate RATE] [--unresolved-rate RATE]
+#                       [--nginx-rate RATE] [--redirect-rate RATE] [--seed SEED]
+#                       [--runs COUNT] [--json FILE] [--keep] [--db sqlite|cli]
+#                       [--fcgi] [-- SCRIPT OPTIONS]
+#   --domains            : how many synthetic domains to create (default: 100)
+#   --latency            : the response time of a status page (default: 5 ms)
+#   --php-update-latency : how long the stand-in of the PHP settings update
+#                          takes for a domain (default: 50 ms)
+#   --failure-rate       : the share of domains answering with HTTP 500
+#   --cloudflare-rate    : the share of domains behind Cloudflare
+#   --unresolved-rate    : the share of domains not resolving to the server
+#   --nginx-rate         : the share of domains with PHP served by nginx
+#   --redirect-rate      : the share of domains redirecting to www.
+#   --runs               : how many times to run the script on the same root,
+#                          the runs after the first show the incremental cost
+#   --json               : write the report to the file as well
+#   --keep               : do not remove the temporary root
+#   --db                 : query a SQLite stand-in of the psa database (sqlite,
+#                          the default) or the stand-in of "plesk db" (cli)
+#   --fcgi               : answer on the php-fpm.sock sockets of the domains with a
+#                          fake FastCGI responder, run phpfpm-status-collector.py
+#                          --once against them and compare its aggregated status
+#                          with the expected one. The domains of --failure-rate
+#                          answer with Status: 500
+#
+# Everything after "--" is passed to 360-phpfpm-plugin-conf.py, e.g.:
+#   360-phpfpm-plugin-conf-bench.py --domains 5000 -- --batch
+#########
+
+from argparse import ArgumentParser, REMAINDER
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import chdir, chmod, environ, getcwd, makedirs, pathsep
+from os.path import abspath, dirname, join
+from random import Random
+from shutil import rmtree
+from socketserver import ThreadingMixIn
+from tempfile import mkdtemp
+from threading import Thread
+from time import monotonic, sleep
+import json
+import os
+import resource
+import selectors
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+
+
+# ==================
+# Defined variables
+# ==================
+
+scriptFile = join(dirname(abspath(__file__)), '360-phpfpm-plugin-conf.py')
+collectorFile = join(dirname(abspath(__file__)), 'phpfpm-status-collector.py')
+serverIP = '203.0.113.10'
+foreignIP = '198.51.100.20'
+phpVersion = '8.2'
+
+# The absolute paths of 360-phpfpm-plugin-conf.py which are moved into the temporary root
+rootedPaths = ('/usr/local/psa/', '/opt/plesk/', '/etc/psa/', '/etc/agent360.ini',
+               '/var/www/vhosts', '/var/lib/360-phpfpm-plugin-conf/', '/usr/local/lib/python3', '/usr/lib/python3')
+agentPluginsDir = '/usr/local/lib/python3/dist-packages/agent360/plugins'
+
+defaultNginxTemplate = """<?php if ($VAR->domain->active && $VAR->domain->physicalHosting->php && $VAR->domain->physicalHosting->proxySettings['nginxServePhp']): ?>
+    location ~ \\.php(/.*)?$ {
+    }
+<?php endif ?>
+        <?php if ($VAR->domain->physicalHosting->directoryIndex && !$VAR->domain->physicalHosting->proxySettings['nginxProxyMode']): ?>
+    index <?php echo $VAR->domain->physicalHosting->directoryIndex ?>;
+        <?php endif ?>
+"""
+defaultApacheTemplate = """<?php if ($OPT['ssl'] || !$VAR->domain->physicalHosting->ssl): ?>
+    Alias "/plesk-stat" "<?php echo $VAR->domain->physicalHosting->statisticsDir ?>"
+    Redirect permanent /awstats-icon https://<?php echo $VAR->domain->urlName ?>/awstats-icon
+<?php endif; ?>
+
+<?php endif; ?>
+</VirtualHost>
+"""
+
+
+#-------------
+# Stand-ins
+#-------------
+
+# The stand-ins log every call to the file from BENCH_LOG and read the
+# synthetic domains from the file from BENCH_FIXTURE
+fakePlesk = """#!/usr/bin/env python3
+import json, os, sys, time
+from glob import glob
+args = sys.argv[1:]
+root = os.environ['BENCH_ROOT']
+with open(os.environ['BENCH_LOG'], 'a') as log:
+    log.write('plesk ' + ' '.join(args[:2]) + '\\n')
+with open(os.environ['BENCH_FIXTURE']) as f:
+    fixture = json.load(f)
+poolDir = root + '/opt/plesk/php/%s/etc/php-fpm.d/'
+statusPath = 'pm.status_path = /status_phpfpm'
+
+def writePool(domain):
+    with open(poolDir + domain + '.conf', 'w') as pool:
+        pool.write('[' + domain + ']\\n' + statusPath + '\\n')
+
+if args[:2] == ['bin', 'license']:
+    sys.exit(0)
+elif args[:3] == ['bin', 'site', '-l']:
+    print('\\n'.join(d['name'] for d in fixture['domains']))
+elif args[:1] == ['db']:
+    query = args[-1]
+    if 'IP_Addresses' in query:
+        print(fixture['serverIP'])
+    elif 'is_resolved' in query:
+        for d in fixture['domains']:
+            print('\\t'.join((d['name'], d['resolved'], d['serve'])))
+elif args[:3] == ['bin', 'site', '--update-php-settings']:
+    time.sleep(fixture['phpUpdateLatency'])
+    writePool(args[3])
+elif args[:2] == ['bin', 'php_settings']:
+    time.sleep(fixture['phpUpdateLatency'])
+    for ini in glob(root + '/var/www/vhosts/system/*/conf/php.ini'):
+        with open(ini) as f:
+            if statusPath in f.read():
+                writePool(ini.split('/')[-3])
+elif args[:2] == ['sbin', 'httpdmng']:
+    time.sleep(fixture['phpUpdateLatency'])
+""".replace('%s', phpVersion)
+
+fakeSystemctl = """#!/bin/sh
+echo "systemctl $1" >> "$BENCH_LOG"
+"""
+
+# Every run of the script is a process of its own, so its atexit handlers run when it ends.
+# The runner moves the paths of the script into BENCH_ROOT, sends its HTTPS probes to the local
+# status pages server, resolves the synthetic domains and counts the processes it spawns
+scriptRunner = """#!/usr/bin/env python3
+import atexit, http.client, json, os, socket, subprocess, sys
+root = os.environ['BENCH_ROOT']
+counts = {}
+
+class LocalConnection(http.client.HTTPConnection):
+    # Keeps the domain in the Host header but talks to the local server
+    def __init__(self, host, port = None, timeout = None, context = None):
+        http.client.HTTPConnection.__init__(self, host, timeout=timeout)
+
+    def connect(self):
+        self.sock = socket.create_connection(('127.0.0.1', int(os.environ['BENCH_HTTP_PORT'])), self.timeout)
+
+class CountingPopen(subprocess.Popen):
+    def __init__(self, args, *posargs, **kwargs):
+        command = args if isinstance(args, str) else ' '.join(args)
+        key = ' '.join(command.split()[:2])
+        counts[key] = counts.get(key, 0) + 1
+        super(CountingPopen, self).__init__(args, *posargs, **kwargs)
+
+def saveCounts():
+    with open(os.environ['BENCH_POPEN'], 'w') as f:
+        json.dump(counts, f)
+
+with open(os.environ['BENCH_FIXTURE']) as f:
+    addresses = dict((d['name'], d['ip']) for d in json.load(f)['domains'])
+resolve = socket.gethostbyname
+socket.gethostbyname = lambda name: addresses[name] if name in addresses else resolve(name)
+http.client.HTTPSConnection = LocalConnection
+subprocess.Popen = CountingPopen
+# Registered before the handlers of the script, so it runs after them
+atexit.register(saveCounts)
+
+scriptFile = sys.argv[1]
+with open(scriptFile) as f:
+    source = f.read()
+for path in json.loads(os.environ['BENCH_ROOTED_PATHS']):
+    source = source.replace(path, root + path)
+sys.argv = sys.argv[1:]
+exec(compile(source, scriptFile, 'exec'), {'__name__': '__main__', '__file__': scriptFile})
+"""
+
+
+# ==================
+# Fixture
+# ==================
+
+def makeFixture(options):
+    rand = Random(options.seed)
+    domains = []
+    for i in range(options.domains):
+        roll = rand.random()
+        domain = {
+            'name': 'site%05d.example.test' % i,
+            'resolved': 'true',
+            'serve': 'true' if rand.random() < options.nginx_rate else 'false',
+            'ip': serverIP,
+            'status': 200,
+            'server': 'nginx',
+            'redirect': rand.random() < options.redirect_rate,
+        }
+        if roll < options.unresolved_rate:
+            domain['ip'] = foreignIP
+        elif roll < options.unresolved_rate + options.cloudflare_rate:
+            domain['server'] = 'cloudflare'
+        elif roll < options.unresolved_rate + options.cloudflare_rate + options.failure_rate:
+            domain['status'] = 500
+        domains.append(domain)
+    return {'serverIP': serverIP, 'phpUpdateLatency': options.php_update_latency / 1000.0, 'domains': domains}
+
+def makeDatabase(databaseFile, fixture):
+    # A SQLite stand-in of the tables of the psa database the script queries
+    conn = sqlite3.connect(databaseFile)
+    conn.executescript("""
+        CREATE TABLE IP_Addresses (id INTEGER PRIMARY KEY, ip_address TEXT);
+        CREATE TABLE domains (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE dom_param (dom_id INTEGER, param TEXT, val TEXT);
+        CREATE TABLE WebServerSettingsParameters (webServerSettingsId INTEGER, name TEXT, value TEXT);
+    """)
+    conn.execute('INSERT INTO IP_Addresses (ip_address) VALUES (?)', (fixture['serverIP'],))
+    for i, d in enumerate(fixture['domains'], 1):
+        conn.execute('INSERT INTO domains (id, name) VALUES (?, ?)', (i, d['name']))
+        conn.executemany('INSERT INTO dom_param (dom_id, param, val) VALUES (?, ?, ?)',
+                         [(i, 'is_resolved', d['resolved']), (i, 'webServerSettingsId', str(i))])
+        conn.execute('INSERT INTO WebServerSettingsParameters VALUES (?, ?, ?)', (i, 'nginxServePhp', d['serve']))
+    conn.commit()
+    conn.close()
+
+def makeRoot(root, fixture):
+    binDir = join(root, 'bin')
+    for path in (binDir, root + '/usr/local/psa/admin/conf/templates/default/domain',
+                 root + '/opt/plesk/php/' + phpVersion + '/etc/php-fpm.d', root + '/etc/psa', root + agentPluginsDir):
+        makedirs(path)
+    for name, content in (('plesk', fakePlesk), ('systemctl', fakeSystemctl)):
+        with open(join(binDir, name), 'w') as f:
+            f.write(content)
+        chmod(join(binDir, name), 0o755)
+    with open(join(root, 'run-script.py'), 'w') as f:
+        f.write(scriptRunner)
+    templates = root + '/usr/local/psa/admin/conf/templates/default/domain/'
+    with open(templates + 'nginxDomainVirtualHost.php', 'w') as f:
+        f.write(defaultNginxTemplate)
+    with open(templates + 'domainVirtualHost.php', 'w') as f:
+        f.write(defaultApacheTemplate)
+    with open(root + agentPluginsDir + '/phpfpm.py', 'w') as f:
+        f.write('class Plugin(object):\n    def run(self, config):\n        return config.get("phpfpm", "status_page_url")\n')
+    with open(root + '/etc/psa/psa.conf', 'w') as f:
+        f.write('HTTPD_VHOSTS_D ' + root + '/var/www/vhosts\n')
+    for d in fixture['domains']:
+        # The pool sockets are only looked for, a plain file is enough
+        makedirs(root + '/var/www/vhosts/system/' + d['name'])
+        open(root + '/var/www/vhosts/system/' + d['name'] + '/php-fpm.sock', 'w').close()
+    with open(join(root, 'fixture.json'), 'w') as f:
+        json.dump(fixture, f)
+    makeDatabase(join(root, 'psa.sqlite'), fixture)
+    return binDir
+
+
+# ====================
+# Status pages server
+# ====================
+
+class StatusPageHandler(BaseHTTPRequestHandler):
+    domains = {}
+    latency = 0
+
+    def respond(self, withBody):
+        sleep(self.latency)
+        host = self.headers.get('Host', '')
+        domain = self.domains.get(host[4:] if host.startswith('www.') else host)
+        if domain is None:
+            self.send_response(404)
+        elif domain['redirect'] and not host.startswith('www.'):
+            self.send_response(301)
+            self.send_header('Location', 'https://www.' + host + self.path)
+        else:
+            self.send_response(domain['status'])
+        self.send_header('Server', domain['server'] if domain else 'nginx')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# ==================
+# FastCGI responder
+# ==================
+
+fcgiHeader = struct.Struct('!BBHHBx')
+fcgiStdin = 5
+fcgiStdout = 6
+fcgiEndRequest = 3
+# The fields the collector sums up and the ones it takes the maximum of
+summedFields = ('accepted conn', 'listen queue', 'listen queue len', 'idle processes',
+                'active processes', 'total processes', 'max children reached', 'slow requests')
+maximumFields = ('max listen queue', 'max active processes', 'start since')
+
+def poolStatus(number, domain):
+    return {
+        'pool': domain['name'], 'process manager': 'ondemand', 'start since': 1000 + number,
+        'accepted conn': number + 1, 'listen queue': number % 2, 'max listen queue': number % 3,
+        'listen queue len': 511, 'idle processes': number % 4, 'active processes': 1,
+        'total processes': 1 + number % 4, 'max active processes': 1 + number % 7,
+        'max children reached': int(number % 5 == 0), 'slow requests': number % 2,
+    }
+
+def expectedAggregation(fixture):
+    expected = {'pools': 0, 'failed pools': 0}
+    for field in summedFields + maximumFields:
+        expected[field] = 0
+    for number, domain in enumerate(fixture['domains']):
+        if domain['status'] != 200:
+            expected['failed pools'] += 1
+            continue
+        status = poolStatus(number, domain)
+        expected['pools'] += 1
+        for field in summedFields:
+            expected[field] += status[field]
+        for field in maximumFields:
+            expected[field] = max(expected[field], status[field])
+    return expected
+
+
+class FakePools(Thread):
+    # Listens on the php-fpm.sock of every domain and answers the FastCGI requests
+    # with the JSON status page of the pool, one connection at a time
+    daemon = True
+
+    def __init__(self, vhostsDir, fixture):
+        Thread.__init__(self)
+        self.selector = selectors.DefaultSelector()
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < len(fixture['domains']) + 100:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, len(fixture['domains']) + 100), hard))
+        for number, domain in enumerate(fixture['domains']):
+            path = vhostsDir + '/system/' + domain['name'] + '/php-fpm.sock'
+            os.remove(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+            listener.listen(16)
+            self.selector.register(listener, selectors.EVENT_READ, (number, domain))
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select():
+                conn, address = key.fileobj.accept()
+                try:
+                    conn.settimeout(5)
+                    self.respond(conn, *key.data)
+                except (IOError, OSError):
+                    pass
+                finally:
+                    conn.close()
+
+    def readRecord(self, conn):
+        header = self.readExactly(conn, fcgiHeader.size)
+        version, recordType, requestId, length, padding = fcgiHeader.unpack(header)
+        return recordType, requestId, self.readExactly(conn, length + padding)[:length]
+
+    def readExactly(self, conn, size):
+        data = b''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise IOError('The connection was closed')
+            data += chunk
+        return data
+
+    def respond(self, conn, number, domain):
+        # The request ends with an empty stdin record
+        while True:
+            recordType, requestId, content = self.readRecord(conn)
+            if recordType == fcgiStdin and not content:
+                break
+        if domain['status'] == 200:
+            output = b'Content-Type: application/json\r\n\r\n' + json.dumps(poolStatus(number, domain)).encode()
+        else:
+            output = b'Status: 500 Internal Server Error\r\nContent-Type: text/plain\r\n\r\nPrimary script unknown'
+        records = b''
+        for offset in range(0, len(output), 65535):
+            chunk = output[offset:offset + 65535]
+            records += fcgiHeader.pack(1, fcgiStdout, requestId, len(chunk), 0) + chunk
+        records += fcgiHeader.pack(1, fcgiStdout, requestId, 0, 0)
+        records += fcgiHeader.pack(1, fcgiEndRequest, requestId, 8, 0) + struct.pack('!IB3x', 0, 0)
+        conn.sendall(records)
+
+
+def runCollector(vhostsDir, fixture):
+    # Runs the collector once against the fake pools and compares the aggregated status
+    started = monotonic()
+    process = subprocess.run([sys.executable, collectorFile, '--once', '--vhosts-dir', vhostsDir],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    duration = monotonic() - started
+    if process.returncode != 0:
+        return {'wall time': duration, 'error': process.stderr.strip(), 'mismatches': {}}
+    aggregated = json.loads(process.stdout)['aggregated']
+    expected = expectedAggregation(fixture)
+    mismatches = dict((field, {'expected': value, 'collected': aggregated.get(field)})
+                      for field, value in expected.items() if aggregated.get(field) != value)
+    return {'wall time': duration, 'pools': aggregated.get('pools'), 'failed pools': aggregated.get('failed pools'), 'mismatches': mismatches}
+
+
+def printCollectorReport(result):
+    if 'error' in result:
+        print('Collector --once failed: ' + result['error'])
+    else:
+        print('Collector --once: {:.2f}s, pools: {}, failed pools: {}, aggregation {}'.format(
+            result['wall time'], result['pools'], result['failed pools'], 'mismatches' if result['mismatches'] else 'matches'))
+        for field, values in sorted(result['mismatches'].items()):
+            print('  {:<25} expected {}, collected {}'.format(field, values['expected'], values['collected']))
+    print()
+
+
+# ==================
+# Instrumentation
+# ==================
+
+def readReport(fileName):
+    # Returns the content of a JSON file the run wrote when it ended, the file is removed for the next run
+    if not os.path.exists(fileName):
+        return {}
+    with open(fileName) as f:
+        report = json.load(f)
+    os.remove(fileName)
+    return report
+
+
+def runScript(root, scriptArgs):
+    # The script runs through the runner in a process of its own, the phases and the busy time
+    # of the stages of its pipeline come from its --timings report
+    timingsFile = join(root, 'timings.json')
+    started = monotonic()
+    process = subprocess.Popen([sys.executable, join(root, 'run-script.py'), scriptFile,
+                                '--state-file', root + '/var/lib/360-phpfpm-plugin-conf/state.json',
+                                '--timings', timingsFile] + scriptArgs,
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    output = process.communicate()[0]
+    finished = monotonic()
+    timings = readReport(timingsFile)
+    return {
+        'exit status': process.returncode,
+        'wall time': finished - started,
+        'phases': [(phase['name'], phase['seconds']) for phase in timings.get('phases', [])],
+        'pipeline stages': timings.get('pipeline stages', {}),
+        'popen calls': readReport(join(root, 'popen.json')),
+        'output': output,
+    }
+
+
+def readCommandLog(logFile):
+    counts = {}
+    try:
+        with open(logFile) as log:
+            for line in log:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+    except IOError:
+        pass
+    open(logFile, 'w').close()
+    return counts
+
+
+def printReport(run, number):
+    print('Run #{}: {:.2f}s, exit status {}'.format(number, run['wall time'], run['exit status']))
+    for name, duration in run['phases']:
+        print('  {:<75} {:>9.3f}s'.format(name, duration))
+    if run['pipeline stages']:
+        print('  Busy time of the pipeline stages, summed over the workers:')
+        for name, duration in run['pipeline stages'].items():
+            print('    {:<73} {:>9.3f}s'.format(name, duration))
+    print('  Processes spawned by the script: {}'.format(sum(run['popen calls'].values())))
+    for command, count in sorted(run['popen calls'].items(), key=lambda c: -c[1]):
+        print('    {:<40} {:>7}'.format(command, count))
+    print('  Stand-in invocations:')
+    for command, count in sorted(run['commands'].items(), key=lambda c: -c[1]):
+        print('    {:<40} {:>7}'.format(command, count))
+    print()
+
+
+# ======
+# Main
+# ======
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run 360-phpfpm-plugin-conf.py against synthetic domains')
+    parser.add_argument('--domains', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=5, help='the response time of a status page, in ms')
+    parser.add_argument('--php-update-latency', type=float, default=50, help='the duration of a PHP settings update, in ms')
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--cloudflare-rate', type=float, default=0.05)
+    parser.add_argument('--unresolved-rate', type=float, default=0.05)
+    parser.add_argument('--nginx-rate', type=float, default=0.5)
+    parser.add_argument('--redirect-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=360)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--json', default=None, help='write the report to the file as well')
+    parser.add_argument('--keep', action='store_true', help='do not remove the temporary root')
+    parser.add_argument('--db', choices=('sqlite', 'cli'), default='sqlite', help='query the SQLite stand-in of the database or the stand-in of "plesk db"')
+    parser.add_argument('--fcgi', action='store_true', help='answer on the pool sockets and check phpfpm-status-collector.py against them')
+    parser.add_argument('scriptArgs', nargs=REMAINDER)
+    options = parser.parse_args()
+    scriptArgs = options.scriptArgs[1:] if options.scriptArgs[:1] == ['--'] else options.scriptArgs
+
+    root = mkdtemp(prefix='360-phpfpm-bench-')
+    fixture = makeFixture(options)
+    binDir = makeRoot(root, fixture)
+    if options.db == 'sqlite':
+        scriptArgs = ['--db-dsn', 'sqlite://' + join(root, 'psa.sqlite')] + scriptArgs
+
+    StatusPageHandler.domains = dict((d['name'], d) for d in fixture['domains'])
+    StatusPageHandler.latency = options.latency / 1000.0
+    httpServer = ThreadingHTTPServer(('127.0.0.1', 0), StatusPageHandler)
+    Thread(target=httpServer.serve_forever, daemon=True).start()
+    if options.fcgi:
+        FakePools(root + '/var/www/vhosts', fixture).start()
+
+    environ.update({
+        'PATH': binDir + pathsep + environ.get('PATH', ''),
+        'BENCH_ROOT': root,
+        'BENCH_LOG': join(root, 'commands.log'),
+        'BENCH_FIXTURE': join(root, 'fixture.json'),
+        'BENCH_POPEN': join(root, 'popen.json'),
+        'BENCH_HTTP_PORT': str(httpServer.server_address[1]),
+        'BENCH_ROOTED_PATHS': json.dumps(rootedPaths),
+        'COLUMNS': '80',
+    })
+
+    print('Domains: {}, root: {}, script options: {}'.format(options.domains, root, ' '.join(scriptArgs) or '-'))
+    print()
+    cwd = getcwd()
+    chdir(root)
+    runs = []
+    try:
+        for number in range(1, options.runs + 1):
+            run = runScript(root, scriptArgs)
+            run['commands'] = readCommandLog(environ['BENCH_LOG'])
+            printReport(run, number)
+            runs.append(run)
+        collector = runCollector(root + '/var/www/vhosts', fixture) if options.fcgi else None
+        if collector:
+            printCollectorReport(collector)
+    finally:
+        chdir(cwd)
+        httpServer.shutdown()
+        if not options.keep:
+            rmtree(root)
+
+    if runs[-1]['exit status']:
+        print(runs[-1]['output'])
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'domains': options.domains, 'scriptArgs': scriptArgs,
+                       'runs': [dict((k, v) for k, v in run.items() if k != 'output') for run in runs],
+                       'collector': collector}, f, indent=2)
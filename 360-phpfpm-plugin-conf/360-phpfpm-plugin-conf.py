@@ -4,13 +4,70 @@
 ###############################################################################
 # This script helps to configure the PHP-FPM plugin for 360 Monitoring
 # Requirements : Python 3.x
-# Version      : 1.4
+# Version      : 1.12
+#
+# Usage        : 360-phpfpm-plugin-conf.py [--batch] [--state-file FILE] [--probe-ttl SECONDS] [--full]
+#                                          [--collector URL] [--shard-size COUNT] [--timings FILE] [--trace]
+#                                          [--workers COUNT] [--db-dsn DSN]
+#   --batch      : stage the PHP-FPM pool settings for all the selected domains
+#                  and apply them with a single web server reconfiguration
+#                  instead of reconfiguring every domain one by one
+#   --state-file : the file to keep the results of the previous runs in
+#                  (default: /var/lib/360-phpfpm-plugin-conf/state.json).
+#                  Only new and changed domains and the domains with expired
+#                  probes are processed again
+#   --probe-ttl  : how long the result of the availability probe of a domain
+#                  stays valid (default: 86400 seconds)
+#   --full       : ignore the state file and process all the domains
+#   --collector  : point the agent to the local phpfpm-status-collector.py
+#                  URL (e.g. http://127.0.0.1:8089/status_phpfpm?json) instead
+#                  of the status pages of the domains. The custom templates are
+#                  not created and the domains are not probed over HTTP, every
+#                  domain with a PHP-FPM pool socket is configured
+#   --shard-size : put at most COUNT status page URLs into one plugin section
+#                  ([phpfpm], [phpfpm_2], ...). The agent runs every section as
+#                  a separate plugin, so the pages are polled in parallel
+#                  (default: 0, all the URLs are in the [phpfpm] section).
+#                  The sections after [phpfpm] need the plugin files phpfpm_2.py,
+#                  ... next to phpfpm.py. They are written to the directory set by
+#                  "plugins" in the [agent] section of /etc/agent360.ini, or else
+#                  to the plugins directory of the installed agent360 package.
+#                  An upgrade of agent360 replaces the package directory and
+#                  removes them: re-run the script after the upgrade, or copy the
+#                  plugins directory elsewhere and set "plugins" in [agent] to it
+#   --timings    : write a JSON report with the duration of every phase, the
+#                  busy time of every stage of the pipeline (probe, templates,
+#                  update) summed over its workers, the number and the duration
+#                  of the external commands and the per-domain latency
+#                  percentiles to FILE ('-' for stdout)
+#   --trace      : print every external command with its duration to stderr
+#   --workers    : how many domains are probed at the same time (default: 8).
+#                  A domain goes to the PHP Settings update as soon as its probe
+#                  qualifies it, while the other domains are still being probed
+#   --db-dsn     : query a stand-in of the psa database instead, e.g.
+#                  sqlite:///tmp/psa.sqlite. By default one connection to the
+#                  psa database is opened with pymysql or MySQLdb, "plesk db" is
+#                  used when neither of them is installed
 #########
 
-from subprocess import Popen, call, PIPE
-from sys import version_info
-from os import get_terminal_size, remove
-from re import sub
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE
+from sys import version_info, stdout, stderr
+from os import remove, makedirs, replace, chown, stat
+from os.path import isfile, isdir, dirname, exists
+from glob import glob
+from shutil import get_terminal_size, copymode
+from re import match
+from time import time, monotonic
+from math import ceil
+from threading import Thread, Lock
+from queue import Queue
+from http.client import HTTPSConnection, HTTPException
+from ssl import create_default_context
+from urllib.parse import urlsplit
+import atexit
+import json
+import socket
 
 
 # ==================
@@ -23,17 +80,23 @@ from re import sub
 
 defaultDir = '/usr/local/psa/admin/conf/templates/default/domain/'
 customDir = '/usr/local/psa/admin/conf/templates/custom/domain/'
-checkDir = '[ -d "/usr/local/psa/admin/conf/templates/custom/domain/" ] && echo 1 || echo 0'
-checkFile = '[ -f "/usr/local/psa/admin/conf/templates/custom/domain/{}" ] && echo 1 || echo 0'
-checkTemplate = 'grep "status_phpfpm" /usr/local/psa/admin/conf/templates/custom/domain/{} > /dev/null && echo 1 || echo 0'
-createCustomDir = 'mkdir -p /usr/local/psa/admin/conf/templates/custom/domain/'
-copyTemplate = 'cp -a /usr/local/psa/admin/conf/templates/default/domain/{0} /usr/local/psa/admin/conf/templates/custom/domain/{0}'
-pleskLicenseCheck = 'plesk bin license -c'
-pleskIPs = 'plesk db -Nse "SELECT ip_address FROM IP_Addresses"'
-getDomainList = 'plesk bin site -l'
-checkIsResolved = 'plesk db -Nse "SELECT val FROM dom_param WHERE param = \'is_resolved\' AND dom_id = (SELECT id FROM domains WHERE name = \'{}\')"'
-checkAvailability = 'curl -s -o /dev/null -w "%{{http_code}}" {}'
-checkCloudflare = 'curl --silent -I {} | grep Server | cut -f 2 -d ":"'
+templateMarker = 'status_phpfpm'
+pleskLicenseCheck = ['plesk', 'bin', 'license', '-c']
+pleskIPs = 'SELECT ip_address FROM IP_Addresses'
+getDomainList = ['plesk', 'bin', 'site', '-l']
+getDomainParams = "SELECT d.name, IFNULL(r.val, ''), IFNULL(w.value, '') FROM domains d LEFT JOIN dom_param r ON r.dom_id = d.id AND r.param = 'is_resolved' LEFT JOIN dom_param s ON s.dom_id = d.id AND s.param = 'webServerSettingsId' LEFT JOIN WebServerSettingsParameters w ON w.webServerSettingsId = s.val AND w.name = 'nginxServePhp'"
+probeTimeout = 30
+
+
+#----------
+# Database
+#----------
+
+pleskDbName = 'psa'
+pleskDbUser = 'admin'
+pleskDbPasswordFile = '/etc/psa/.psa.shadow'
+pleskDbSockets = ['/var/run/mysqld/mysqld.sock', '/var/lib/mysql/mysql.sock']
+pleskDbQuery = ['plesk', 'db', '-Nse', '{}']
 
 
 #--------
@@ -90,9 +153,46 @@ pluginConfNginx = """\n    location ~ ^/status_phpfpm$ {
 # PHP
 #-----
 
-checkPHPServe = 'plesk db -Nse "SELECT value FROM WebServerSettingsParameters WHERE webServerSettingsId = (SELECT val FROM dom_param WHERE param = \'webServerSettingsId\' AND dom_id = (SELECT id FROM domains WHERE name = \'{}\')) AND name = \'nginxServePhp\'"'
-checkPHPAdditionalSettings = 'grep -ir \'pm.status_path = /status_phpfpm\' /opt/plesk/php/*/etc/php-fpm.d/{}.conf > /dev/null && echo 1 || echo 0'
-phpUpdate = 'plesk bin site --update-php-settings {} -additional-settings tmpfile'
+phpUpdate = ['plesk', 'bin', 'site', '--update-php-settings', '{}', '-additional-settings', 'tmpfile']
+phpStatusPath = 'pm.status_path = /status_phpfpm'
+phpPoolSection = '[php-fpm-pool-settings]'
+phpPoolConfigs = '/opt/plesk/php/*/etc/php-fpm.d/{}.conf'
+pleskConfFile = '/etc/psa/psa.conf'
+defaultVhostsDir = '/var/www/vhosts'
+domainPhpIni = '{}/system/{}/conf/php.ini'
+domainPhpSocket = '{}/system/{}/php-fpm.sock'
+phpSettingsUpdate = ['plesk', 'bin', 'php_settings', '-u']
+reconfigureDomains = ['plesk', 'sbin', 'httpdmng', '--reconfigure-domains', '{}']
+# Linux limits one argument to 128 KiB, the staged domains are reconfigured in parts below it
+reconfigureArgumentLimit = 100 * 1024
+
+
+#-------
+# State
+#-------
+
+defaultStateFile = '/var/lib/360-phpfpm-plugin-conf/state.json'
+defaultProbeTTL = 86400
+configurableCategories = ('nginx', 'apache')
+
+
+#---------
+# Timings
+#---------
+
+timings = {'phases': [], 'stages': {'probe': 0.0, 'templates': 0.0, 'update': 0.0}, 'commands': {}, 'domains': {}, 'first configured': None}
+timingsLock = Lock()
+slowestDomainsCount = 10
+
+
+#----------
+# Pipeline
+#----------
+
+defaultWorkers = 8
+# How many domains may wait between the stages per probe worker
+queueSizePerWorker = 4
+pipelineState = {'templatesReady': False, 'templatesError': None, 'stagedDomains': [], 'updatedCount': 0}
 
 
 #-----------
@@ -100,13 +200,41 @@ phpUpdate = 'plesk bin site --update-php-settings {} -additional-settings tmpfil
 #-----------
 
 agentConfFile = '/etc/agent360.ini'
-phpFPMConf = """\n[phpfpm]
-enabled = yes\n"""
-statusPageLine = 'status_page_url ='
-statusPageUrlSearch = 'status_page_url'
-agentRestart = 'systemctl restart agent360'
-checkConf = 'grep \'\[phpfpm\]\' /etc/agent360.ini > /dev/null && echo 1 || echo 0'
-parseConf = 'sed -n "/^\[phpfpm\]$/,/^\[/p" /etc/agent360.ini'
+agentRestart = ['systemctl', 'restart', 'agent360']
+pluginSection = 'phpfpm'
+shardSection = 'phpfpm_{}'
+shardSectionPattern = r'^phpfpm_\d+$'
+agentPluginsDirs = ['/usr/local/lib/python3*/*-packages/agent360/plugins', '/usr/lib/python3*/*-packages/agent360/plugins']
+shardPluginMarker = '# Generated by 360-phpfpm-plugin-conf.py'
+# Every shard is a copy of the phpfpm plugin which reads its own section of the configuration
+shardPlugin = shardPluginMarker + """
+import os
+import importlib.util
+
+spec = importlib.util.spec_from_file_location('phpfpm', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'phpfpm.py'))
+phpfpm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(phpfpm)
+
+
+class ShardConfig(object):
+    def __init__(self, config):
+        self.config = config
+
+    def __getattr__(self, name):
+        method = getattr(self.config, name)
+        def remapped(*args, **kwargs):
+            if args and args[0] == 'phpfpm':
+                args = (__name__,) + args[1:]
+            return method(*args, **kwargs)
+        return remapped if callable(method) else method
+
+
+class Plugin(phpfpm.Plugin):
+    __name__ = __name__
+
+    def run(self, config):
+        return phpfpm.Plugin.run(self, ShardConfig(config))
+"""
 
 
 #---------------------
@@ -128,21 +256,187 @@ def prGreen(textToPrint):
 def prBlue(textToPrint):
     printFunc("\033[96m {}\033[00m".format(textToPrint))
 
-def getIndex(string, file):
-    with open(file) as f:
-        for i, line in enumerate(f):
-            if string in line:
-                return i
+def recordCommand(template, started, details):
+    duration = monotonic() - started
+    with timingsLock:
+        stats = timings['commands'].setdefault(template, {'count': 0, 'seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += duration
+    if options.trace:
+        stderr.write("[trace] {:.3f}s {}\n".format(duration, details))
+    return duration
+
+def runCommand(command, *args):
+    # Runs the command without a shell, the arguments are put in place of the '{}' items
+    started = monotonic()
+    template = " ".join(command)
+    command = [item.format(*args) if item == '{}' else item for item in command]
+    process = Popen(command, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    out, err = process.communicate()
+    recordCommand(template, started, " ".join(command)[:200])
+    return process.returncode, out, err
+
+def runChecked(command, *args):
+    returnCode, out, err = runCommand(command, *args)
+    if returnCode != 0:
+        prRed("[-] The command '{}' failed: {}".format(" ".join(command[:3]), err.strip() or "exit code {}".format(returnCode)))
+    return out
+
+class PleskDB(object):
+    # One connection to the psa database for the whole run, the queries take their parameters as %s.
+    # Without a MySQL driver (pymysql or MySQLdb) the queries go through "plesk db" with the parameters
+    # quoted. A "sqlite:///path/to/file" DSN points the queries to a SQLite stand-in of the database
+    def __init__(self, dsn = None):
+        self.dsn = dsn
+        self.conn = None
+        self.connected = False
+        self.placeholder = '%s'
+        self.errors = ()
+        self.lock = Lock()
+
+    def connect(self):
+        self.connected = True
+        if self.dsn and self.dsn.startswith('sqlite://'):
+            import sqlite3
+            self.conn = sqlite3.connect(self.dsn[len('sqlite://'):], check_same_thread=False)
+            self.placeholder = '?'
+            self.errors = (sqlite3.Error,)
+            return
+        try:
+            import pymysql as driver
+            credentials = {'user': pleskDbUser, 'database': pleskDbName}
+            passwordKey = 'password'
+        except ImportError:
+            try:
+                import MySQLdb as driver
+                credentials = {'user': pleskDbUser, 'db': pleskDbName}
+                passwordKey = 'passwd'
+            except ImportError:
+                return
+        try:
+            with open(pleskDbPasswordFile) as passwordFile:
+                credentials[passwordKey] = passwordFile.read().strip()
+            sockets = [sock for sock in pleskDbSockets if exists(sock)]
+            if sockets:
+                credentials['unix_socket'] = sockets[0]
+            else:
+                credentials['host'] = 'localhost'
+            self.conn = driver.connect(connect_timeout=10, charset='utf8', **credentials)
+            self.errors = (driver.Error,)
+        except (IOError, OSError, driver.Error):
+            # The CLI is used when the database cannot be reached directly
+            self.conn = None
+
+    def inline(self, query, params):
+        quoted = ["'" + str(param).replace('\\', '\\\\').replace("'", "\\'") + "'" for param in params]
+        parts = query.split('%s')
+        return parts[0] + ''.join(value + part for value, part in zip(quoted, parts[1:]))
+
+    def query(self, query, params = ()):
+        # Returns the rows as tuples of strings, NULL is returned as an empty string
+        with self.lock:
+            if not self.connected:
+                self.connect()
+            if self.conn is None:
+                return [tuple(row.split('\t')) for row in runChecked(pleskDbQuery, self.inline(query, params)).splitlines()]
+            started = monotonic()
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(query.replace('%s', self.placeholder), tuple(params))
+                return [tuple('' if value is None else str(value) for value in row) for row in cursor.fetchall()]
+            except self.errors as e:
+                prRed("[-] The database query failed: {}".format(e))
+                return []
+            finally:
+                cursor.close()
+                recordCommand('db query', started, query[:200])
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def writeFile(fileName, content):
+    # The file is replaced at once, so it is never left half-written. The new file gets the mode
+    # and the owner of the old one before the content is written, the old one may hold secrets
+    directory = dirname(fileName)
+    if directory and not isdir(directory):
+        makedirs(directory)
+    with open(fileName + '.tmp', 'w') as f:
+        if isfile(fileName):
+            fileStat = stat(fileName)
+            copymode(fileName, fileName + '.tmp')
+            chown(fileName + '.tmp', fileStat.st_uid, fileStat.st_gid)
+        f.write(content)
+    replace(fileName + '.tmp', fileName)
 
 def adjustTemplate(tplFile, searchLine, pluginConf, index):
     with open(defaultDir + tplFile, 'r') as template:
         tplData = template.readlines()
 
-    tplData.insert(getIndex(searchLine, defaultDir + tplFile) + index, pluginConf)
+    lineIndex = [i for i, line in enumerate(tplData) if searchLine in line]
+    if not lineIndex:
+        raise ValueError("The line to insert the configuration after is not found in " + defaultDir + tplFile)
+    tplData.insert(lineIndex[0] + index, pluginConf)
+
+    writeFile(customDir + tplFile, "".join(tplData))
+    copymode(defaultDir + tplFile, customDir + tplFile)
+
+def isTemplateAdjusted(tplFile):
+    with open(customDir + tplFile) as template:
+        return templateMarker in template.read()
+
+def prepareTemplates():
+    prBlue(fillTheLine("*", 51))
+    prBlue(">>> Checking the current state of the templates...")
+    prBlue(fillTheLine("*", 51))
+    printFunc()
+
+    if options.collector:
+        printFunc(" The status is collected from the PHP-FPM sockets directly, the templates are not needed")
+        printFunc()
+        return
+
+    # Check if the custom templates exist in general
+    if isdir(customDir):
+    # Look for the Nginx template
+        if isfile(customDir + nginxTemplateFile):
+            if isTemplateAdjusted(nginxTemplateFile):
+                printFunc(" [!] The Nginx template already contains the data about PHP-FPM status")
+                printFunc(" [!] Please parse it manually to check the consistency")
+                printFunc()
+            else:
+                prRed("[-] The Nginx custom template already exists. Please adjust it manually")
+                printFunc()
+        else:
+            printFunc(" Creating the necessary Nginx template file...")
+            adjustTemplate(nginxTemplateFile, searchNginxLine, pluginConfNginx, -1)
+            prGreen("[+] The Nginx template has been created")
+            printFunc()
 
-    with open(customDir + tplFile, 'w') as template:
-        tplData = "".join(tplData)
-        template.write(tplData)
+    # Look for the Apache template
+        if isfile(customDir + apacheTemplateFile):
+            if isTemplateAdjusted(apacheTemplateFile):
+                printFunc(" [!] The Apache template already contains the data about PHP-FPM status")
+                printFunc(" [!] Please parse it manually to check the consistency")
+                printFunc()
+            else:
+                prRed("[-] The Apache custom template already exists. Please adjust it manually")
+                printFunc()
+        else:
+            printFunc(" Creating the necessary template file...")
+            adjustTemplate(apacheTemplateFile, searchApacheLine, pluginConfApache, 4)
+            prGreen("[+] The Apache template has been created")
+            printFunc()
+    else:
+        printFunc(" Creating the necessary template file")
+        adjustTemplate(nginxTemplateFile, searchNginxLine, pluginConfNginx, -1)
+        printFunc()
+        prGreen("[+] The Nginx template has been created")
+        adjustTemplate(apacheTemplateFile, searchApacheLine, pluginConfApache, 4)
+        printFunc()
+        prGreen("[+] The Apache template has been created")
+    printFunc()
 
 def fillTheLine(symbol, multiplier = 0):
     columns, rows = get_terminal_size()
@@ -150,27 +444,406 @@ def fillTheLine(symbol, multiplier = 0):
         multiplier = columns - 5
     return symbol * multiplier
 
-def checkIPs(domain):
-    result = False
-    ipList = []
+def parseIni(content):
+    # Splits the file into sections keeping all the lines as they are, the lines before the first section go to None
+    sections = [[None, []]]
+    for line in content.splitlines(True):
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            sections.append([stripped[1:-1].strip(), [line]])
+        else:
+            sections[-1][1].append(line)
+    return sections
+
+def renderIni(sections):
+    return "".join("".join(lines) for name, lines in sections)
+
+def isIniOption(line, option):
+    return '=' in line and not line.lstrip().startswith((';', '#')) and line.split('=', 1)[0].strip() == option
+
+def getIniOption(sections, section, option):
+    for name, lines in sections:
+        if name == section:
+            for line in lines[1:]:
+                if isIniOption(line, option):
+                    return line.split('=', 1)[1].strip()
+    return None
+
+def setIniOption(sections, section, option, value):
+    optionLine = option + ' = ' + value + '\n'
+    for name, lines in sections:
+        if name == section:
+            for i in range(1, len(lines)):
+                if isIniOption(lines[i], option):
+                    lines[i] = optionLine
+                    return
+            # Keep the blank lines at the end of the section after the new option
+            position = len(lines)
+            while position > 1 and not lines[position - 1].strip():
+                position -= 1
+            if not lines[position - 1].endswith('\n'):
+                lines[position - 1] += '\n'
+            lines.insert(position, optionLine)
+            return
+    lastLines = sections[-1][1]
+    if lastLines and not lastLines[-1].endswith('\n'):
+        lastLines[-1] += '\n'
+    if lastLines and lastLines[-1].strip():
+        lastLines.append('\n')
+    sections.append([section, ['[' + section + ']\n', optionLine]])
+
+def removeIniSection(sections, section):
+    sections[:] = [s for s in sections if s[0] != section]
+
+def getAgentPluginsDir(sections):
+    # Returns the plugins directory and whether it belongs to the agent360 package
+    pluginsDir = getIniOption(sections, 'agent', 'plugins')
+    if pluginsDir and isdir(pluginsDir):
+        return pluginsDir, False
+    for pattern in agentPluginsDirs:
+        for candidate in sorted(glob(pattern)):
+            if isfile(candidate + '/' + pluginSection + '.py'):
+                return candidate, True
+    return None, False
+
+def updateShardPlugins(pluginsDir, shardNames):
+    # Creates the plugin files for the shards and removes the ones which are not needed anymore
+    for pluginFile in glob(pluginsDir + '/' + shardSection.format('*') + '.py'):
+        shardName = pluginFile[len(pluginsDir) + 1:-3]
+        if shardName not in shardNames:
+            with open(pluginFile) as plugin:
+                isGenerated = plugin.readline().startswith(shardPluginMarker)
+            if isGenerated:
+                remove(pluginFile)
+    for shardName in shardNames:
+        pluginFile = pluginsDir + '/' + shardName + '.py'
+        if not isfile(pluginFile):
+            writeFile(pluginFile, shardPlugin)
+
+def getVhostsDir():
+    if isfile(pleskConfFile):
+        with open(pleskConfFile) as conf:
+            for line in conf:
+                option = line.split()
+                if len(option) == 2 and option[0] == 'HTTPD_VHOSTS_D':
+                    return option[1].rstrip('/')
+    return defaultVhostsDir
+
+def isStatusPathApplied(domain):
+    for poolConf in glob(phpPoolConfigs.format(domain)):
+        with open(poolConf, errors='replace') as conf:
+            if any(line.strip() == phpStatusPath for line in conf):
+                return True
+    return False
+
+def stagePhpSettings(domain, vhostsDir):
+    # Put the pool directive into the domain's custom php.ini, Plesk applies it on the next reconfiguration
+    iniFile = domainPhpIni.format(vhostsDir, domain)
+    iniData = []
+    if isfile(iniFile):
+        with open(iniFile) as ini:
+            iniData = ini.readlines()
+    if any(line.strip() == phpStatusPath for line in iniData):
+        return False
+    sectionIndex = [i for i, line in enumerate(iniData) if line.strip() == phpPoolSection]
+    if sectionIndex:
+        iniData.insert(sectionIndex[0] + 1, phpStatusPath + '\n')
+    else:
+        if iniData and not iniData[-1].endswith('\n'):
+            iniData[-1] += '\n'
+        iniData.append(phpPoolSection + '\n' + phpStatusPath + '\n')
+    writeFile(iniFile, "".join(iniData))
+    return True
+
+def splitDomainList(domains, limit):
+    # Splits the domains into parts whose comma-separated lists are at most limit bytes long
+    parts = [[]]
+    length = 0
+    for domain in domains:
+        size = len(domain.encode()) + 1
+        if parts[-1] and length + size > limit:
+            parts.append([])
+            length = 0
+        parts[-1].append(domain)
+        length += size
+    return [part for part in parts if part]
+
+def getServerIPs():
+    return [row[0].strip() for row in pleskDB.query(pleskIPs)]
+
+def checkIPs(domain, ipList):
     hostIPs = []
-    ipArray = Popen(pleskIPs, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True).stdout.readlines()
-    for ip in ipArray:
-        ipList.append(ip.rstrip())
     try:
         hostIPs.append(socket.gethostbyname(domain))
-    except:
-        result = False
-    if any(i in hostIPs for i in ipList):
-        result = True
-    return result
+    except (socket.error, UnicodeError):
+        return False
+    return any(i in hostIPs for i in ipList)
+
+def getDomainsParams():
+    params = {}
+    for row in pleskDB.query(getDomainParams):
+        if len(row) == 3:
+            params[row[0]] = (row[1], row[2])
+    return params
+
+sslContext = None
+
+def probeUrl(url):
+    # Returns the status code and the Server header of the page, the status is 0 if the page is not reachable
+    global sslContext
+    if sslContext is None:
+        sslContext = create_default_context()
+    started = monotonic()
+    parts = urlsplit(url)
+    conn = HTTPSConnection(parts.hostname, timeout=probeTimeout, context=sslContext)
+    try:
+        conn.request('GET', parts.path or '/')
+        response = conn.getresponse()
+        return response.status, response.getheader('Server', '')
+    except (OSError, HTTPException):
+        return 0, ''
+    finally:
+        conn.close()
+        recordCommand('https probe', started, 'GET ' + url)
+
+def classifyDomain(d, resolvedResult, serveBool, ipList):
+    # Returns the category of the domain and the name its status page is available on
+    if 'true' not in resolvedResult or not checkIPs(d, ipList):
+        return 'unavailable', d
+    sCode, server = probeUrl('https://' + d)
+    if 'cloudflare' in server.lower():
+        return 'cloudflare', d
+    target = d
+    if 300 <= sCode < 400:
+        sCodeWww, server = probeUrl('https://www.' + d)
+        if sCodeWww != 200:
+            return 'unavailable', d
+        target = 'www.' + d
+    elif sCode != 200:
+        return 'unavailable', d
+    if 'true' in serveBool:
+        return 'nginx', target
+    elif 'false' in serveBool:
+        return 'apache', target
+    return 'unavailable', d
+
+def classifyDomainLocal(d, serveBool, vhostsDir):
+    # The collector talks to the pool socket, so only the socket has to exist
+    if not exists(domainPhpSocket.format(vhostsDir, d)):
+        return 'unavailable', d
+    if 'true' in serveBool:
+        return 'nginx', d
+    return 'apache', d
+
+def startPhase(name):
+    now = monotonic()
+    if timings['phases'] and 'seconds' not in timings['phases'][-1]:
+        timings['phases'][-1]['seconds'] = now - timings['phases'][-1]['started']
+    timings['phases'].append({'name': name, 'started': now})
+
+def addStageTime(stage, seconds):
+    # The stages of the pipeline overlap, so their busy time is kept apart from the phases
+    with timingsLock:
+        timings['stages'][stage] += seconds
+
+def addDomainTime(domain, seconds):
+    with timingsLock:
+        timings['domains'][domain] = timings['domains'].get(domain, 0.0) + seconds
+
+def percentile(values, share):
+    # Nearest-rank percentile of the sorted values
+    if not values:
+        return 0.0
+    return values[max(0, int(ceil(share * len(values))) - 1)]
+
+def writeTimings():
+    startPhase(None)
+    timings['phases'].pop()
+    latencies = sorted(timings['domains'].values())
+    report = {
+        'phases': [{'name': p['name'], 'seconds': round(p['seconds'], 6)} for p in timings['phases']],
+        'total seconds': round(sum(p['seconds'] for p in timings['phases']), 6),
+        'pipeline stages': dict((k, round(v, 6)) for k, v in timings['stages'].items()),
+        'first configured domain seconds': timings['first configured'],
+        'commands': dict((k, {'count': v['count'], 'seconds': round(v['seconds'], 6)}) for k, v in timings['commands'].items()),
+        'domains': {
+            'count': len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0,
+            'slowest': [{'domain': d, 'seconds': round(t, 6)} for d, t in
+                        sorted(timings['domains'].items(), key=lambda item: -item[1])[:slowestDomainsCount]],
+        },
+    }
+    if options.timings == '-':
+        stdout.write(json.dumps(report, indent=2) + "\n")
+    else:
+        writeFile(options.timings, json.dumps(report, indent=2))
+
+def updateDomain(domainName, vhostsDir):
+    # Returns True if the pool of the domain has the status page configured or staged
+    if isStatusPathApplied(domainName):
+        return True
+    if options.batch:
+        if stagePhpSettings(domainName, vhostsDir):
+            printFunc(" Staged PHP Settings for the domain " + domainName)
+        pipelineState['stagedDomains'].append(domainName)
+        return False
+    printFunc(" Update PHP Settings for the domain " + domainName + "...")
+    started = monotonic()
+    callPhpUpdate, out, err = runCommand(phpUpdate, domainName)
+    addDomainTime(domainName, monotonic() - started)
+    if callPhpUpdate != 0:
+        prRed("[-] Unable to update the PHP Settings for the domain {}: {}".format(domainName, err.strip()))
+        return False
+    pipelineState['updatedCount'] += 1
+    return True
+
+def runPipeline(domainList, domainsParams, vhostsDir):
+    # The domains flow from the inventory through the probe workers to the PHP Settings update,
+    # the queues between the stages are bounded so a slow stage holds back the previous one
+    probeQueue = Queue(maxsize=options.workers * queueSizePerWorker)
+    updateQueue = Queue(maxsize=options.workers * queueSizePerWorker)
+    started = monotonic()
+    now = int(time())
+    serverIPs = []
+
+    def probeDomain(d, resolvedResult, serveBool, fingerprint, previous):
+        probeStarted = monotonic()
+        try:
+            if options.collector:
+                category, target = classifyDomainLocal(d, serveBool, vhostsDir)
+            else:
+                category, target = classifyDomain(d, resolvedResult, serveBool, serverIPs)
+        except Exception as e:
+            prRed("[-] Unable to check the domain {}: {}".format(d, e))
+            category, target = 'unavailable', d
+        configured = bool(previous and previous.get('configured') and previous.get('target') == target)
+        domainsState[d] = {'fingerprint': fingerprint, 'category': category, 'target': target, 'probed': now, 'configured': configured}
+        addDomainTime(d, monotonic() - probeStarted)
+        return category in configurableCategories
+
+    # A failure of one domain must not stop a worker: the other stages would wait for it forever
+    def probeWorker():
+        while True:
+            item = probeQueue.get()
+            if item is None:
+                return
+            stageStarted = monotonic()
+            try:
+                qualified = probeDomain(*item)
+            except Exception as e:
+                prRed("[-] Unable to check the domain {}: {}".format(item[0], e))
+                domainsState[item[0]] = {'fingerprint': item[3], 'category': 'unavailable', 'target': item[0], 'probed': now, 'configured': False}
+                qualified = False
+            addStageTime('probe', monotonic() - stageStarted)
+            if qualified:
+                updateQueue.put(item[0])
+
+    def updateWorker():
+        while True:
+            d = updateQueue.get()
+            if d is None:
+                return
+            # The templates go first, the PHP Settings update reconfigures the web server of the domain.
+            # Without them no domain is updated, the queue is only drained so the probes do not block
+            if not pipelineState['templatesReady'] and not pipelineState['templatesError']:
+                stageStarted = monotonic()
+                try:
+                    prepareTemplates()
+                    pipelineState['templatesReady'] = True
+                except Exception as e:
+                    prRed("[-] Unable to prepare the templates: {}".format(e))
+                    pipelineState['templatesError'] = str(e)
+                addStageTime('templates', monotonic() - stageStarted)
+            if pipelineState['templatesError']:
+                continue
+            stageStarted = monotonic()
+            try:
+                domainsState[d]['configured'] = updateDomain(d, vhostsDir)
+            except Exception as e:
+                prRed("[-] Unable to update the PHP Settings for the domain {}: {}".format(d, e))
+            addStageTime('update', monotonic() - stageStarted)
+            if domainsState[d]['configured'] and timings['first configured'] is None:
+                timings['first configured'] = monotonic() - started
+
+    # Inventory: the domains with a valid saved state skip the probe stage
+    toProbe = []
+    for d in domainList:
+        resolvedResult, serveBool = domainsParams.get(d, ('', ''))
+        fingerprint = resolvedResult + '|' + serveBool + ('|collector' if options.collector else '')
+        entry = domainsState.get(d)
+        if not entry or entry.get('fingerprint') != fingerprint or now - entry.get('probed', 0) > options.probe_ttl:
+            toProbe.append((d, resolvedResult, serveBool, fingerprint, entry))
+    if toProbe and not options.collector:
+        serverIPs.extend(getServerIPs())
+
+    updater = Thread(target=updateWorker)
+    updater.start()
+    probers = [Thread(target=probeWorker) for i in range(max(1, options.workers))]
+    for prober in probers:
+        prober.start()
+
+    # The configured domains are checked again as well, Plesk may have regenerated their pools
+    # without the status path. The check only reads the pool configuration
+    probed = set(item[0] for item in toProbe)
+    for d in domainList:
+        entry = domainsState.get(d)
+        if d not in probed and entry['category'] in configurableCategories:
+            updateQueue.put(d)
+    for item in toProbe:
+        probeQueue.put(item)
+
+    for prober in probers:
+        probeQueue.put(None)
+    for prober in probers:
+        prober.join()
+    updateQueue.put(None)
+    updater.join()
+    return len(toProbe)
+
+def loadState(stateFile):
+    try:
+        with open(stateFile) as state:
+            return json.load(state).get('domains', {})
+    except (IOError, ValueError):
+        return {}
+
+def saveState(stateFile, domainsState):
+    writeFile(stateFile, json.dumps({'version': 1, 'domains': domainsState}, indent=1, sort_keys=True))
+
+
+# ===================
+# Parse the options
+# ===================
+parser = ArgumentParser(description='Configure the PHP-FPM plugin for 360 Monitoring')
+parser.add_argument('--batch', action='store_true', help='stage the PHP settings for all the domains and apply them with a single reconfiguration')
+parser.add_argument('--state-file', default=defaultStateFile, help='the file to keep the results of the previous runs in')
+parser.add_argument('--probe-ttl', type=int, default=defaultProbeTTL, help='how long the availability probe of a domain stays valid, in seconds')
+parser.add_argument('--full', action='store_true', help='ignore the saved state and process all the domains')
+parser.add_argument('--collector', default=None, help='the URL of the local PHP-FPM status collector to use instead of the status pages of the domains')
+parser.add_argument('--shard-size', type=int, default=0, help='the maximum number of the status page URLs in one plugin section')
+parser.add_argument('--timings', default=None, help='write the timing report in JSON to the file (- for stdout)')
+parser.add_argument('--trace', action='store_true', help='print every external command with its duration to stderr')
+parser.add_argument('--workers', type=int, default=defaultWorkers, help='how many domains are probed at the same time')
+parser.add_argument('--db-dsn', default=None, help='the database to query instead of the psa database, e.g. sqlite:///tmp/psa.sqlite')
+options = parser.parse_args()
+
+pleskDB = PleskDB(options.db_dsn)
+atexit.register(pleskDB.close)
+
+if options.timings:
+    atexit.register(writeTimings)
+
+domainsState = {} if options.full else loadState(options.state_file)
 
 
 # ===================
 # Preliminary checks
 # ===================
-licenseCheck = Popen(pleskLicenseCheck, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-out, err = licenseCheck.communicate()
+startPhase('license check')
+returnCode, out, err = runCommand(pleskLicenseCheck)
 if '1' in err:
     printFunc()
     prRed("[!] Unable to proceed further due to the invalid Plesk license")
@@ -189,9 +862,9 @@ prBlue(fillTheLine("*", 45))
 printFunc()
 
 # Generate a list of all domains on the server
-domains = Popen(getDomainList, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-for domain in domains.stdout:
-    domainList.append(domain.rstrip())
+startPhase('domain listing')
+for domain in runChecked(getDomainList).splitlines():
+    domainList.append(domain.strip())
 
 if not domainList:
     prRed("There are no domains on this server")
@@ -201,40 +874,49 @@ if not domainList:
 if 'example.com' in domainList:
     domainList.remove('example.com')
 
-# Check the availability of the domains and group them
+# Drop the domains which were removed from the server since the previous run
+for d in list(domainsState):
+    if d not in domainList:
+        del domainsState[d]
+
+domainsParams = getDomainsParams()
+vhostsDir = getVhostsDir()
+
+printFunc(" Checking the new and changed domains and updating their PHP Settings as soon as they qualify...")
+printFunc()
+startPhase('pipeline')
+
+if not options.batch:
+    # Create a temporary file
+    with open("tmpfile", "w") as tmpFile:
+        tmpFile.write("[php-fpm-pool-settings]\npm.status_path = /status_phpfpm")
+
+processedCount = runPipeline(domainList, domainsParams, vhostsDir)
+
+if not options.batch:
+    # Remove the temporary file
+    remove("tmpfile")
+
+# Group the domains in the order they are listed on the server
 for d in domainList:
-    isResolved = Popen(checkIsResolved.format(d), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-    resolvedResult = isResolved.stdout.readline()
-    isCloudflare = Popen(checkCloudflare.format(d), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-    clResult = isCloudflare.stdout.readline()
-    if 'true' not in resolvedResult or not checkIPs(d):
-        unavailableDomains.append(d)
-    elif 'cloudflare' in clResult:
+    entry = domainsState[d]
+    if entry['category'] == 'nginx':
+        nginxDomains.append(entry['target'])
+    elif entry['category'] == 'apache':
+        apacheDomains.append(entry['target'])
+    elif entry['category'] == 'cloudflare':
         cloudflareDomains.append(d)
     else:
-        nginxApachePhp = Popen(checkPHPServe.format(d), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-        serveBool = nginxApachePhp.stdout.readline()
-        statusCode = Popen(checkAvailability.format('https://' + d), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-        sCode = statusCode.stdout.readline()
-        if '30' in sCode:
-            statusCodeWww = Popen(checkAvailability.format('https://www.' + d), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-            sCodeWww = statusCodeWww.stdout.readline()
-            if '200' in sCodeWww:
-                if 'true' in serveBool:
-                    nginxDomains.append('www.' + d)
-                elif 'false' in serveBool:
-                    apacheDomains.append('www.' + d)
-                else:
-                    unavailableDomains.append(d)
-        elif '200' in sCode:
-            if 'true' in serveBool:
-                nginxDomains.append(d)
-            elif 'false' in serveBool:
-                apacheDomains.append(d)
-            else:
-                unavailableDomains.append(d)
-        else:
-            unavailableDomains.append(d)
+        unavailableDomains.append(d)
+
+saveState(options.state_file, domainsState)
+printFunc()
+if pipelineState['templatesError']:
+    prRed("[-] The PHP Settings have not been updated because the templates could not be prepared")
+    prRed("Please fix the issue and re-run this script")
+    quit(1)
+printFunc(" Processed {} new, changed or expired domain(s), reused the saved results for {}".format(processedCount, len(domainList) - processedCount))
+printFunc()
 
 if not nginxDomains and not apacheDomains:
     prRed("There are no domains on this server")
@@ -246,70 +928,12 @@ printFunc()
 prBlue(fillTheLine("-"))
 printFunc()
 
-
-# ==================
-# Analyze templates
-# ==================
-
-prBlue(fillTheLine("*", 51))
-prBlue(">>> Checking the current state of the templates...")
-prBlue(fillTheLine("*", 51))
-printFunc()
-
-# Check if the custom templates exist in general
-isDirExists = Popen(checkDir, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-if '1' in isDirExists.stdout.readline():
-    isNginxFileExists = Popen(checkFile.format(nginxTemplateFile), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-    isApacheFileExists = Popen(checkFile.format(apacheTemplateFile), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-
-# Look for the Nginx template
-    if '1' in isNginxFileExists.stdout.readline():
-        isTemplateExists = Popen(checkTemplate.format(nginxTemplateFile), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-        if '1' in isTemplateExists.stdout.readline():
-            printFunc(" [!] The Nginx template already contains the data about PHP-FPM status")
-            printFunc(" [!] Please parse it manually to check the consistency")
-            printFunc()
-        else:
-            prRed("[-] The Nginx custom template already exists. Please adjust it manually")
-            printFunc()
-    else:
-        printFunc(" Creating the necessary Nginx template file...")
-        call(copyTemplate.format(nginxTemplateFile), stdout=PIPE, stderr=PIPE, shell=True)
-        adjustTemplate(nginxTemplateFile, searchNginxLine, pluginConfNginx, -1)
-        prGreen("[+] The Nginx template has been created")
-        printFunc()
-
-# Look for the Apache template
-    if '1' in isApacheFileExists.stdout.readline():
-        isTemplateExists = Popen(checkTemplate.format(apacheTemplateFile), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-        if '1' in isTemplateExists.stdout.readline():
-            printFunc(" [!] The Apache template already contains the data about PHP-FPM status")
-            printFunc(" [!] Please parse it manually to check the consistency")
-            printFunc()
-        else:
-            prRed("[-] The Apache custom template already exists. Please adjust it manually")
-            printFunc()
-    else:
-        printFunc(" Creating the necessary template file...")
-        call(copyTemplate.format(apacheTemplateFile), stdout=PIPE, stderr=PIPE, shell=True)
-        adjustTemplate(apacheTemplateFile, searchApacheLine, pluginConfApache, 4)
-        prGreen("[+] The Apache template has been created")
-        printFunc()
-else:
-    printFunc(" Creating the necessary template file")
-    call(createCustomDir, stdout=PIPE, stderr=PIPE, shell=True)
-    call(copyTemplate.format(nginxTemplateFile), stdout=PIPE, stderr=PIPE, shell=True)
-    call(copyTemplate.format(apacheTemplateFile), stdout=PIPE, stderr=PIPE, shell=True)
-
-    adjustTemplate(nginxTemplateFile, searchNginxLine, pluginConfNginx, -1)
-    printFunc()
-    prGreen("[+] The Nginx template has been created")
-    adjustTemplate(apacheTemplateFile, searchApacheLine, pluginConfApache, 4)
+# The templates are needed even if all the domains were configured by the previous runs
+if not pipelineState['templatesReady']:
+    startPhase('templates')
+    prepareTemplates()
+    prBlue(fillTheLine("-"))
     printFunc()
-    prGreen("[+] The Apache template has been created")
-
-prBlue(fillTheLine("-"))
-printFunc()
 
 
 # ====================
@@ -318,26 +942,44 @@ printFunc()
 
 prBlue(fillTheLine("*", 43))
 prBlue(">>> Starting of the PHP Settings update...")
+startPhase('php settings')
 prBlue(fillTheLine("*", 43))
 printFunc()
 
-# Create a temporary file
-with open("tmpfile", "w") as tmpFile:
-    tmpFile.write("[php-fpm-pool-settings]\npm.status_path = /status_phpfpm")
-
-# Adjust the configuration
-for d in (nginxDomains + apacheDomains):
-    isPHPAdditionalSettings = Popen(checkPHPAdditionalSettings.format(d), stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-    if '0' in isPHPAdditionalSettings.stdout.readline():
-        printFunc(" Update PHP Settings for the domain " + d.replace('www.', '') + "...")
-        callPhpUpdate = call(phpUpdate.format(d.replace('www.', '')), stdout=PIPE, stderr=PIPE, shell=True)
+if options.batch:
+    # Apply the pool settings staged by the pipeline at once
+    stagedDomains = pipelineState['stagedDomains']
+    if stagedDomains:
+        printFunc(" Applying the staged PHP Settings for {} domain(s)...".format(len(stagedDomains)))
+        runChecked(phpSettingsUpdate)
+        domainParts = splitDomainList(stagedDomains, reconfigureArgumentLimit)
+        for number, part in enumerate(domainParts, 1):
+            try:
+                returnCode, out, err = runCommand(reconfigureDomains, ",".join(part))
+            except OSError as e:
+                returnCode, err = -1, str(e)
+            if returnCode == 0:
+                printFunc(" Reconfigured {} domain(s), part {} of {}".format(len(part), number, len(domainParts)))
+            else:
+                prRed("[-] The reconfiguration of {} domain(s), part {} of {}, failed with exit code {}: {}".format(len(part), number, len(domainParts), returnCode, err.strip()))
+        appliedDomains = [d for d in stagedDomains if isStatusPathApplied(d)]
+        for d in appliedDomains:
+            domainsState[d]['configured'] = True
+        printFunc()
+        prGreen("[+] Staged: {}, applied: {}".format(len(stagedDomains), len(appliedDomains)))
+        for d in stagedDomains:
+            if d not in appliedDomains:
+                prRed("[-] The PHP Settings were not applied for the domain " + d)
+    else:
+        printFunc(" There are no domains to update")
+else:
+    printFunc(" The PHP Settings of {} domain(s) have been updated while they were checked".format(pipelineState['updatedCount']))
 
 printFunc()
 prGreen("[+] The PHP Settings have been adjusted")
 printFunc()
 
-# Remove the temporary file
-remove("tmpfile")
+saveState(options.state_file, domainsState)
 
 prBlue(fillTheLine("-"))
 printFunc()
@@ -349,40 +991,56 @@ printFunc()
 
 prBlue(fillTheLine("*", 79))
 prBlue(">>> Adjusting the PHP-FPM plugin configuration for the 360 Monitoring agent...")
+startPhase('agent config')
 prBlue(fillTheLine("*", 79))
 printFunc()
 
 # Generate a list of links to the status pages of all configured domains
-for d in (nginxDomains + apacheDomains):
-    urlsList.append('https://' + d.rstrip() + '/status_phpfpm?json')
-
-# Prepare the necessary line fot the agent360 configuration file
-for url in urlsList:
-    statusPageLine += ' ' + url + ','
-
-# Remove the trailing comma
-statusPageLine = statusPageLine[:-1] + "\n\n"
-
-# Check the current configuration and adjust it to enable PHP-FPM for all prepared domains
-isPluginEnabled = Popen(checkConf, stdout=PIPE, stderr=PIPE, universal_newlines=True, shell=True)
-if '1' in isPluginEnabled.stdout.readline():
-    phpSection = getIndex('[phpfpm]',agentConfFile)
-    with open(agentConfFile, "r") as conf:
-        confContent = conf.readlines()
-    for i in confContent:
-        itemIndex = confContent.index(i)
-        if statusPageUrlSearch in i:
-            if not (phpSection - itemIndex) >= 0:
-                confContent[itemIndex] = statusPageLine
-    with open(agentConfFile, "w") as conf:
-        confContent = "".join(confContent)
-        confContent = sub(r'\n\s*\n', '\n\n', confContent)
-        conf.write(confContent)
+if options.collector:
+    urlsList.append(options.collector)
 else:
-    with open(agentConfFile, "a+") as conf:
-        conf.write(phpFPMConf + statusPageLine)
+    for d in (nginxDomains + apacheDomains):
+        urlsList.append('https://' + d.rstrip() + '/status_phpfpm?json')
 
-prGreen("[+] The plugin configuration has been adjusted")
+# Split the links between the plugin sections
+if options.shard_size > 0 and len(urlsList) > options.shard_size:
+    urlShards = [urlsList[i:i + options.shard_size] for i in range(0, len(urlsList), options.shard_size)]
+else:
+    urlShards = [urlsList]
+shardNames = [pluginSection] + [shardSection.format(i) for i in range(2, len(urlShards) + 1)]
+
+# Adjust the configuration to enable PHP-FPM for all prepared domains
+originalContent = ''
+if isfile(agentConfFile):
+    with open(agentConfFile) as conf:
+        originalContent = conf.read()
+confSections = parseIni(originalContent)
+for name in [s[0] for s in confSections if s[0] and match(shardSectionPattern, s[0]) and s[0] not in shardNames]:
+    removeIniSection(confSections, name)
+for name, urls in zip(shardNames, urlShards):
+    setIniOption(confSections, name, 'enabled', 'yes')
+    setIniOption(confSections, name, 'status_page_url', ', '.join(urls))
+confContent = renderIni(confSections)
+
+configChanged = confContent != originalContent
+if configChanged:
+    writeFile(agentConfFile, confContent)
+
+if len(shardNames) > 1 or any(match(shardSectionPattern, s[0] or '') for s in parseIni(originalContent)):
+    pluginsDir, isPackageDir = getAgentPluginsDir(confSections)
+    if pluginsDir:
+        updateShardPlugins(pluginsDir, shardNames[1:])
+        if isPackageDir and len(shardNames) > 1:
+            prRed("[!] The plugin files of the sections {} are written to {}".format(", ".join(shardNames[1:]), pluginsDir))
+            printFunc(" It is the directory of the agent360 package, an upgrade of agent360 removes the files and the sections stop reporting")
+            printFunc(" Please re-run the script after the upgrade, or copy the directory elsewhere and set it as \"plugins\" in the [agent] section of " + agentConfFile)
+    else:
+        prRed("[-] Unable to find the plugins directory of the agent, the plugin sections {} will not work".format(", ".join(shardNames[1:])))
+
+if configChanged:
+    prGreen("[+] The plugin configuration has been adjusted")
+else:
+    prGreen("[+] The plugin configuration is up to date")
 printFunc()
 prBlue(fillTheLine("-"))
 printFunc()
@@ -394,11 +1052,14 @@ printFunc()
 
 prBlue(fillTheLine("*", 57))
 prBlue(">>> Restarting the service to apply the configuration...")
+startPhase('agent restart')
 prBlue(fillTheLine("*", 57))
 printFunc()
-callRestart = call(agentRestart, stdout=PIPE, stderr=PIPE, shell=True)
-
-prGreen("[+] The command to restart the service has been executed")
+if configChanged:
+    runChecked(agentRestart)
+    prGreen("[+] The command to restart the service has been executed")
+else:
+    printFunc(" The configuration has not changed, the restart is not needed")
 printFunc()
 prBlue(fillTheLine("-"))
 printFunc()
@@ -408,6 +1069,7 @@ printFunc()
 # Show the results
 # =========================================
 
+startPhase('report')
 prBlue(fillTheLine("="))
 printFunc()
 prBlue(fillTheLine("*", 57))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+### Copyright 1999-2024. Plesk International GmbH.
+
+###############################################################################
+# This script collects the PHP-FPM status of all the domains directly from
+# the php-fpm.sock sockets of their pools and exposes it to the 360 Monitoring
+# agent on a single local URL, so the agent does not have to go through DNS,
+# TLS and the web server of every domain
+# Requirements : Python 3.x
+# Version      : 1.0
+#
+# Usage        : phpfpm-status-collector.py [--listen ADDRESS:PORT] [--vhosts-dir DIR]
+#                                           [--timeout SECONDS] [--workers COUNT]
+#                                           [--cache-ttl SECONDS] [--once]
+#   --listen     : the address to serve the status on (default: 127.0.0.1:8089)
+#   --vhosts-dir : the virtual hosts directory (default: HTTPD_VHOSTS_D from
+#                  /etc/psa/psa.conf or /var/www/vhosts)
+#   --timeout    : the timeout of a request to one pool (default: 2 seconds)
+#   --workers    : how many pools are queried at the same time (default: 32)
+#   --cache-ttl  : how long the collected status is reused (default: 5 seconds)
+#   --once       : print the aggregated status once and exit
+#
+# Endpoints    : /status_phpfpm  - the status of all the pools summed up in the
+#                                  format of the PHP-FPM status page
+#                /pools          - the status of every pool
+#                /pools/<domain> - the status of the pool of the domain
+#
+# The pools must have "pm.status_path = /status_phpfpm" in their settings,
+# 360-phpfpm-plugin-conf.py --collector takes care of it. To keep the
+# collector running, create /etc/systemd/system/phpfpm-status-collector.service:
+#
+#   [Unit]
+#   Description=PHP-FPM status collector for 360 Monitoring
+#   After=network.target
+#
+#   [Service]
+#   ExecStart=/usr/bin/python3 /usr/local/bin/phpfpm-status-collector.py
+#   Restart=always
+#
+#   [Install]
+#   WantedBy=multi-user.target
+#########
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import basename, dirname, isfile
+from socketserver import ThreadingMixIn
+from threading import Lock
+from time import time
+import json
+import socket
+import struct
+
+
+# ==================
+# Defined variables
+# ==================
+
+pleskConfFile = '/etc/psa/psa.conf'
+defaultVhostsDir = '/var/www/vhosts'
+poolSockets = '{}/system/*/php-fpm.sock'
+statusPath = '/status_phpfpm'
+defaultListen = '127.0.0.1:8089'
+
+
+#----------
+# FastCGI
+#----------
+
+fcgiVersion = 1
+fcgiBeginRequest = 1
+fcgiEndRequest = 3
+fcgiParams = 4
+fcgiStdin = 5
+fcgiStdout = 6
+fcgiStderr = 7
+fcgiResponder = 1
+fcgiRequestId = 1
+fcgiHeader = struct.Struct('!BBHHBx')
+
+
+#------------
+# Aggregation
+#------------
+
+# Counters which are summed up over all the pools, the rest of the numeric
+# values are taken as the maximum over all the pools
+summedFields = ('accepted conn', 'listen queue', 'listen queue len', 'idle processes',
+                'active processes', 'total processes', 'max children reached', 'slow requests')
+maximumFields = ('max listen queue', 'max active processes', 'start since')
+
+
+#---------------------
+# Auxiliary functions
+#---------------------
+
+def getVhostsDir():
+    if isfile(pleskConfFile):
+        with open(pleskConfFile) as conf:
+            for line in conf:
+                option = line.split()
+                if len(option) == 2 and option[0] == 'HTTPD_VHOSTS_D':
+                    return option[1].rstrip('/')
+    return defaultVhostsDir
+
+def findPools(vhostsDir):
+    # Returns the sockets of the pools keyed by the domain name
+    return dict((basename(dirname(sock)), sock) for sock in glob(poolSockets.format(vhostsDir)))
+
+def fcgiRecord(recordType, content):
+    return fcgiHeader.pack(fcgiVersion, recordType, fcgiRequestId, len(content), 0) + content
+
+def fcgiNameValue(name, value):
+    pair = b''
+    for item in (name, value):
+        if len(item) < 128:
+            pair += struct.pack('!B', len(item))
+        else:
+            pair += struct.pack('!I', len(item) | 0x80000000)
+    return pair + name + value
+
+def fcgiStatusRequest(path = statusPath, query = 'json'):
+    params = {
+        'GATEWAY_INTERFACE': 'FastCGI/1.0',
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': path,
+        'SCRIPT_FILENAME': path,
+        'REQUEST_URI': path + '?' + query,
+        'QUERY_STRING': query,
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+    }
+    paramsData = b''.join(fcgiNameValue(k.encode(), v.encode()) for k, v in params.items())
+    return (fcgiRecord(fcgiBeginRequest, struct.pack('!HB5x', fcgiResponder, 0))
+            + fcgiRecord(fcgiParams, paramsData) + fcgiRecord(fcgiParams, b'')
+            + fcgiRecord(fcgiStdin, b''))
+
+def readExactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise IOError('The FastCGI connection was closed unexpectedly')
+        data += chunk
+    return data
+
+def fcgiQuery(address, timeout, family = socket.AF_UNIX):
+    # Sends the status request to the pool and returns the body of the response
+    conn = socket.socket(family, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(address)
+        conn.sendall(fcgiStatusRequest())
+        stdout = b''
+        stderr = b''
+        while True:
+            version, recordType, requestId, length, padding = fcgiHeader.unpack(readExactly(conn, fcgiHeader.size))
+            content = readExactly(conn, length + padding)[:length]
+            if recordType == fcgiStdout:
+                stdout += content
+            elif recordType == fcgiStderr:
+                stderr += content
+            elif recordType == fcgiEndRequest:
+                break
+    finally:
+        conn.close()
+    headers, separator, body = stdout.partition(b'\r\n\r\n')
+    if not separator:
+        headers, separator, body = stdout.partition(b'\n\n')
+    for header in headers.splitlines():
+        name, _, value = header.partition(b':')
+        if name.strip().lower() == b'status' and not value.strip().startswith(b'200'):
+            raise IOError('The pool responded with the status ' + value.strip().decode(errors='replace')
+                          + ' ' + stderr.decode(errors='replace').strip())
+    return body
+
+def getPoolStatus(sock, timeout):
+    try:
+        return json.loads(fcgiQuery(sock, timeout).decode(errors='replace'))
+    except (IOError, OSError, ValueError) as e:
+        return {'error': str(e)}
+
+def collectStatus(pools, timeout, workers):
+    # Queries all the pools at the same time
+    if not pools:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(pools))) as executor:
+        results = executor.map(lambda sock: getPoolStatus(sock, timeout), pools.values())
+        return dict(zip(pools.keys(), results))
+
+def aggregateStatus(statuses):
+    aggregated = {'pool': 'all', 'process manager': 'mixed', 'pools': 0, 'failed pools': 0}
+    for field in summedFields + maximumFields:
+        aggregated[field] = 0
+    for status in statuses.values():
+        if 'error' in status:
+            aggregated['failed pools'] += 1
+            continue
+        aggregated['pools'] += 1
+        for field in summedFields:
+            aggregated[field] += status.get(field, 0)
+        for field in maximumFields:
+            aggregated[field] = max(aggregated[field], status.get(field, 0))
+    return aggregated
+
+
+# ===========
+# Collector
+# ===========
+
+class StatusCollector(object):
+    def __init__(self, vhostsDir, timeout, workers, cacheTTL):
+        self.vhostsDir = vhostsDir
+        self.timeout = timeout
+        self.workers = workers
+        self.cacheTTL = cacheTTL
+        self.lock = Lock()
+        self.collected = 0
+        self.statuses = {}
+
+    def getStatuses(self):
+        # Concurrent requests of the agent share one collection round
+        with self.lock:
+            if time() - self.collected > self.cacheTTL:
+                self.statuses = collectStatus(findPools(self.vhostsDir), self.timeout, self.workers)
+                self.collected = time()
+            return self.statuses
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    collector = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        statuses = self.collector.getStatuses()
+        if path == statusPath:
+            self.sendJSON(200, aggregateStatus(statuses))
+        elif path == '/pools':
+            self.sendJSON(200, statuses)
+        elif path.startswith('/pools/') and path[len('/pools/'):] in statuses:
+            self.sendJSON(200, statuses[path[len('/pools/'):]])
+        else:
+            self.sendJSON(404, {'error': 'Not found'})
+
+    def sendJSON(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# ======
+# Main
+# ======
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Collect the PHP-FPM status of all the pools for 360 Monitoring')
+    parser.add_argument('--listen', default=defaultListen, help='the address to serve the status on')
+    parser.add_argument('--vhosts-dir', default=None, help='the virtual hosts directory')
+    parser.add_argument('--timeout', type=float, default=2, help='the timeout of a request to one pool')
+    parser.add_argument('--workers', type=int, default=32, help='how many pools are queried at the same time')
+    parser.add_argument('--cache-ttl', type=float, default=5, help='how long the collected status is reused')
+    parser.add_argument('--once', action='store_true', help='print the aggregated status once and exit')
+    options = parser.parse_args()
+
+    collector = StatusCollector(options.vhosts_dir or getVhostsDir(), options.timeout, options.workers, options.cache_ttl)
+    if options.once:
+        statuses = collector.getStatuses()
+        print(json.dumps({'aggregated': aggregateStatus(statuses), 'pools': statuses}, indent=2, sort_keys=True))
+    else:
+        host, _, port = options.listen.rpartition(':')
+        StatusHandler.collector = collector
+        ThreadingHTTPServer((host, int(port)), StatusHandler).serve_forever()
@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+### Copyright 1999-2024. Plesk International GmbH.
+
+###############################################################################
+# This script runs the checks of 360-restrictions-check.py against synthetic
+# inputs without touching the server: iptables-save, ipset, ip6tables-save and
+# nft are replaced with stand-ins printing generated rulesets, the Fail2Ban
+# logs, jail.local and panel.ini are generated in a temporary root and the
+# psa database is replaced with a SQLite stand-in with a large cp_access table.
+# With --fail2ban socket a stand-in of the Fail2Ban server answers on its
+# control socket instead of the logs.
+# It reports the wall time and the memory use of every check, so regressions
+# of the matching code show up before it is deployed. Every check runs in a
+# forked process: max RSS is the peak of the process of that check alone and
+# +RSS is how much it grew over the RSS the process had when the check started
+# Requirements : Python 3.x
+# Version      : 1.0
+#
+# Usage        : 360-restrictions-check-bench.py [--rules COUNT] [--ipsets COUNT]
+#                       [--ipset-size COUNT] [--firewall iptables|nft]
+#                       [--log-mb MB] [--rotated COUNT] [--cp-access COUNT]
+#                       [--api-networks COUNT] [--targets COUNT] [--timeout SECONDS] [--seed SEED]
+#                       [--runs COUNT] [--cache] [--trace-memory]
+#                       [--fail2ban logs|socket|socket-legacy] [--banned COUNT]
+#                       [--json FILE] [--keep] [--fixtures]
+#   --rules        : how many firewall rules to generate (default: 10000)
+#   --ipsets       : how many ipsets the rules refer to (default: 10)
+#   --ipset-size   : how many addresses every ipset has (default: 10000)
+#   --firewall     : generate the output of iptables-save and ipset save
+#                    (iptables, the default) or of nft -j list ruleset (nft)
+#   --log-mb       : the size of the Fail2Ban logs in MB, split between the
+#                    current log and the rotated ones (default: 100)
+#   --rotated      : how many rotated logs there are, all of them but the
+#                    newest one are compressed (default: 3)
+#   --cp-access    : how many rows the cp_access table has (default: 10000)
+#   --api-networks : how many networks allowedIPs of panel.ini has (default: 1000)
+#   --targets      : how many synthetic IP addresses to check along with the
+#                    addresses of Plesk 360 (default: 0)
+#   --timeout      : how long every check may take (default: 3600 seconds)
+#   --runs         : how many times to run the checks on the same root
+#   --cache        : keep the results in a cache file in the root, the runs
+#                    after the first show the cost of the cached checks. A
+#                    thousand lines are added to the current Fail2Ban log before
+#                    every run after the first, so its scan is incremental
+#   --trace-memory : report the peak of the memory allocated by every check
+#                    with tracemalloc, the checks run slower with it
+#   --fail2ban     : where the Fail2Ban check finds the bans: in the generated
+#                    logs (logs, the default), from a stand-in of the server on
+#                    /var/run/fail2ban/fail2ban.sock (socket) or from a stand-in
+#                    refusing the "banned" command of Fail2Ban 0.11, so the bans
+#                    are queried with "status" per jail (socket-legacy). The
+#                    commands the stand-in got are reported and compared with the
+#                    expected ones, the exit code is 1 when they differ
+#   --banned       : how many addresses the stand-in bans (default: 10000)
+#   --json         : write the report to the file as well
+#   --keep         : do not remove the temporary root
+#   --fixtures     : only evaluate the rulesets in fixtures/firewall and compare
+#                    the verdicts with expected.json of every case, the exit code
+#                    is 1 when any of them differs. A case has the outputs of
+#                    iptables-save, ipset save, ip6tables-save, nft -j list ruleset
+#                    and ip -o addr show in the files iptables-save, ipset-save,
+#                    ip6tables-save, nft.json and ip-addr
+#
+# For example, a large host:
+#   360-restrictions-check-bench.py --rules 100000 --ipsets 50 --log-mb 2048
+#########
+
+from argparse import ArgumentParser
+from collections import Counter
+from os import chmod, environ, listdir, makedirs, pathsep
+from os.path import abspath, dirname, exists, getsize, join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import monotonic
+import gzip
+import json
+import os
+import pickle
+import resource
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import threading
+import tracemalloc
+import types
+
+
+# ==================
+# Defined variables
+# ==================
+
+scriptFile = join(dirname(abspath(__file__)), '360-restrictions-check.py')
+fixturesDir = join(dirname(abspath(__file__)), 'fixtures', 'firewall')
+
+# The absolute paths of 360-restrictions-check.py which are moved into the temporary root
+rootedPaths = ('/var/log/', '/etc/fail2ban/', '/var/run/fail2ban/', '/usr/local/psa/',
+               '/etc/psa/', '/var/lib/360-restrictions-check/')
+serverHostname = 'localhost'
+jails = ('sshd', 'plesk-apache', 'plesk-modsecurity', 'plesk-postfix', 'recidive')
+otherPorts = ('22', '25', '80', '443', '993', '3306')
+
+
+#-------------
+# Stand-ins
+#-------------
+
+# The stand-ins print the generated files from BENCH_ROOT
+fakeCommands = {
+    'iptables-save': 'cat "$BENCH_ROOT/iptables-save"',
+    'ip6tables-save': 'cat "$BENCH_ROOT/ip6tables-save"',
+    'ipset': 'cat "$BENCH_ROOT/ipset-save"',
+    'nft': 'cat "$BENCH_ROOT/nft-ruleset.json"',
+    'ip': 'cat "$BENCH_ROOT/ip-addr"',
+    'curl': 'exit 0',
+    # The hostname maps to the loopback address in /etc/hosts, so the public resolver is asked
+    'dig': 'echo 203.0.113.80',
+}
+
+f2bEndCommand = b'<F2B_END_COMMAND>'
+f2bCloseCommand = b'<F2B_CLOSE_COMMAND>'
+
+
+class Fail2BanHandler(socketserver.BaseRequestHandler):
+    # Answers the pickled commands of a connection, all the commands received at once are one round trip
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        buffer = b''
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return
+            *messages, buffer = (buffer + chunk).split(f2bEndCommand)
+            replies = []
+            names = set()
+            for message in messages:
+                if message == f2bCloseCommand:
+                    return
+                command = pickle.loads(message)
+                name = ' '.join(command[:1] + ['JAIL'] * (len(command) > 1) + command[2:])
+                names.add(name)
+                with server.lock:
+                    server.commands[name] += 1
+                replies.append(pickle.dumps(server.answer(command), 2) + f2bEndCommand)
+            with server.lock:
+                server.roundTrips.update(names)
+            self.request.sendall(b''.join(replies))
+
+
+class Fail2BanStandIn(socketserver.ThreadingUnixStreamServer):
+    # Knows the commands of fail2ban-client the check sends, the legacy one refuses "banned" like Fail2Ban 0.10
+    daemon_threads = True
+
+    def __init__(self, socketFile, bans, ignored, legacy = False):
+        self.bans = bans
+        self.ignored = ignored
+        self.legacy = legacy
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.commands = Counter()
+        self.roundTrips = Counter()
+        super(Fail2BanStandIn, self).__init__(socketFile, Fail2BanHandler)
+
+    def answer(self, command):
+        if command == ['status']:
+            return 0, [('Number of jail', len(self.bans)), ('Jail list', ', '.join(self.bans))]
+        if command == ['banned'] and not self.legacy:
+            return 0, [{jail: ips} for jail, ips in self.bans.items()]
+        if len(command) == 2 and command[0] == 'status' and command[1] in self.bans:
+            ips = self.bans[command[1]]
+            return 0, [('Filter', [('Currently failed', 0), ('Total failed', len(ips)), ('File list', ['/var/log/secure'])]),
+                       ('Actions', [('Currently banned', len(ips)), ('Total banned', len(ips)), ('Banned IP list', ips)])]
+        if len(command) == 3 and command[0] == 'get' and command[1] in self.bans and command[2] == 'ignoreip':
+            return 0, self.ignored
+        return 1, 'Invalid command {!r}'.format(command)
+
+
+# ==================
+# Fixture
+# ==================
+
+def randomIP(rand, excluded):
+    while True:
+        ip = '{}.{}.{}.{}'.format(rand.randint(11, 99), rand.randint(0, 255), rand.randint(0, 255), rand.randint(1, 254))
+        if ip not in excluded:
+            return ip
+
+def makeTargets(plesk360IPs, count):
+    return plesk360IPs + ['198.18.{}.{}'.format(i // 250, i % 250 + 1) for i in range(count)]
+
+def makeIptables(rand, options, targets):
+    # Returns the outputs of iptables-save and ipset save. The Fail2Ban chains and the ipsets come
+    # first like on a real host, the rule dropping the last target is the last one of INPUT,
+    # so the whole ruleset is walked for it
+    excluded = set(targets)
+    chains = ['f2b-' + jail for jail in jails]
+    ipsets = ['blocklist{}'.format(i) for i in range(options.ipsets)]
+    ipsetLines = []
+    for number, name in enumerate(ipsets):
+        ipsetLines.append('create {} hash:{} family inet hashsize 4096 maxelem {}'.format(name, 'net' if number % 2 else 'ip', options.ipset_size * 2))
+        for i in range(options.ipset_size):
+            ipsetLines.append('add {} {}{}'.format(name, randomIP(rand, excluded), '/24' if number % 2 and i % 4 == 0 else ''))
+    if ipsets:
+        ipsetLines.append('add {} {}'.format(ipsets[-1], targets[0]))
+
+    lines = ['*filter', ':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]']
+    lines += [':{} - [0:0]'.format(chain) for chain in chains]
+    lines.append('-A INPUT -i lo -j ACCEPT')
+    lines.append('-A INPUT -m state --state RELATED,ESTABLISHED -j ACCEPT')
+    lines += ['-A INPUT -p tcp -m multiport --dports 22,80,443,8443 -j {}'.format(chain) for chain in chains]
+    lines += ['-A INPUT -m set --match-set {} src -j DROP'.format(name) for name in ipsets[:-1]]
+    # The last ipset only blocks other ports, it must not decide the verdict of port 8443
+    lines += ['-A INPUT -p tcp -m tcp --dport 22 -m set --match-set {} src -j DROP'.format(name) for name in ipsets[-1:]]
+    chainRules = options.rules // 2
+    for i in range(options.rules - len(lines)):
+        if i < chainRules:
+            lines.append('-A {} -s {}/32 -j REJECT --reject-with icmp-port-unreachable'.format(chains[i % len(chains)], randomIP(rand, excluded)))
+        else:
+            port = otherPorts[i % len(otherPorts)] if i % 3 else '8443'
+            lines.append('-A INPUT -s {}/{} -p tcp -m tcp --dport {} -j DROP'.format(randomIP(rand, excluded), rand.choice((32, 32, 24)), port))
+    lines += ['-A {} -j RETURN'.format(chain) for chain in chains]
+    lines.append('-A INPUT -s {}/32 -p tcp -m tcp --dport 8443 -j DROP'.format(targets[-1]))
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n', '\n'.join(ipsetLines) + '\n'
+
+def makeNftRuleset(rand, options, targets):
+    # Returns the output of nft -j list ruleset with the same layout as the iptables ruleset
+    excluded = set(targets)
+    family, table = 'inet', 'filter'
+    objects = [{'metainfo': {'version': '1.0.2', 'json_schema_version': 1}}, {'table': {'family': family, 'name': table, 'handle': 1}}]
+    objects.append({'chain': {'family': family, 'table': table, 'name': 'input', 'handle': 1, 'type': 'filter', 'hook': 'input', 'prio': 0, 'policy': 'accept'}})
+    chains = ['f2b-' + jail for jail in jails]
+    objects += [{'chain': {'family': family, 'table': table, 'name': chain, 'handle': 2 + i}} for i, chain in enumerate(chains)]
+    ipsets = ['blocklist{}'.format(i) for i in range(options.ipsets)]
+    for number, name in enumerate(ipsets):
+        elements = [randomIP(rand, excluded) for i in range(options.ipset_size)]
+        if number % 2:
+            elements = [{'prefix': {'addr': ip, 'len': 24}} if i % 4 == 0 else ip for i, ip in enumerate(elements)]
+        if number == len(ipsets) - 1:
+            elements.append(targets[0])
+        objects.append({'set': {'family': family, 'table': table, 'name': name, 'type': 'ipv4_addr', 'flags': ['interval'], 'elem': elements}})
+
+    handle = [100]
+    def rule(chain, *expressions):
+        handle[0] += 1
+        objects.append({'rule': {'family': family, 'table': table, 'chain': chain, 'handle': handle[0], 'expr': list(expressions)}})
+    def match(protocol, field, value):
+        return {'match': {'op': '==', 'left': {'payload': {'protocol': protocol, 'field': field}}, 'right': value}}
+
+    rule('input', {'match': {'op': '==', 'left': {'meta': {'key': 'iifname'}}, 'right': 'lo'}}, {'accept': None})
+    for chain in chains:
+        rule('input', match('tcp', 'dport', {'set': [22, 80, 443, 8443]}), {'jump': {'target': chain}})
+    for name in ipsets[:-1]:
+        rule('input', match('ip', 'saddr', '@' + name), {'drop': None})
+    for name in ipsets[-1:]:
+        rule('input', match('tcp', 'dport', 22), match('ip', 'saddr', '@' + name), {'drop': None})
+    chainRules = options.rules // 2
+    for i in range(options.rules - len(chains) - len(ipsets) - 1):
+        if i < chainRules:
+            rule(chains[i % len(chains)], match('ip', 'saddr', randomIP(rand, excluded)), {'reject': None})
+        else:
+            port = int(otherPorts[i % len(otherPorts)] if i % 3 else 8443)
+            rule('input', match('ip', 'saddr', {'prefix': {'addr': randomIP(rand, excluded), 'len': rand.choice((32, 32, 24))}}), match('tcp', 'dport', port), {'drop': None})
+    for chain in chains:
+        rule(chain, {'return': None})
+    rule('input', match('ip', 'saddr', targets[-1]), match('tcp', 'dport', 8443), {'drop': None})
+    return json.dumps({'nftables': objects})
+
+def makeLogBlock(rand, excluded, lines = 20000):
+    # A block of Found, Ban and Unban records of the other addresses, the logs repeat it
+    block = []
+    for i in range(lines):
+        jail = rand.choice(jails)
+        ip = randomIP(rand, excluded)
+        stamp = '2024-05-{:02d} {:02d}:{:02d}:{:02d},{:03d}'.format(1 + i % 28, i % 24, i % 60, (i * 7) % 60, i % 1000)
+        roll = rand.random()
+        if roll < 0.8:
+            block.append('{} fail2ban.filter         [1021]: INFO    [{}] Found {} - {}\n'.format(stamp, jail, ip, stamp[:19]))
+        elif roll < 0.9:
+            block.append('{} fail2ban.actions        [1021]: NOTICE  [{}] Ban {}\n'.format(stamp, jail, ip))
+        else:
+            block.append('{} fail2ban.actions        [1021]: NOTICE  [{}] Unban {}\n'.format(stamp, jail, ip))
+    return ''.join(block).encode()
+
+def writeLog(path, size, block, events, compressed):
+    # The events about the targets are spread over the log in their order
+    stream = gzip.open(path, 'wb', compresslevel=1) if compressed else open(path, 'wb')
+    with stream:
+        written = 0
+        pending = list(events)
+        step = max(1, size // (len(pending) + 1))
+        while written < size or pending:
+            stream.write(block)
+            written += len(block)
+            if pending and written >= step * (len(events) - len(pending) + 1):
+                stream.write(pending.pop(0).encode())
+
+def makeFail2BanLogs(rand, options, targets, logDir):
+    # The first target is banned and unbanned in the oldest log, the second one stays banned
+    # from the current log on and the third one only has Found records
+    excluded = set(targets)
+    block = makeLogBlock(rand, excluded)
+    stamp = '2024-05-01 12:00:00,000'
+    event = stamp + ' fail2ban.actions        [1021]: NOTICE  [{}] {} {}\n'
+    found = stamp + ' fail2ban.filter         [1021]: INFO    [sshd] Found {} - 2024-05-01 12:00:00\n'
+    logs = ['fail2ban.log.{}{}'.format(i, '.gz' if i > 1 else '') for i in range(options.rotated, 0, -1)] + ['fail2ban.log']
+    size = options.log_mb * 1024 * 1024 // len(logs)
+    for number, name in enumerate(logs):
+        events = []
+        if number == 0:
+            events = [event.format('sshd', 'Ban', targets[0]), event.format('sshd', 'Unban', targets[0])]
+        if len(targets) > 2:
+            events.append(found.format(targets[2]))
+        if number == len(logs) - 1:
+            events.append(event.format('plesk-apache', 'Ban', targets[1]))
+        writeLog(join(logDir, name), size, block, events, name.endswith('.gz'))
+    return [join(logDir, name) for name in logs], block
+
+def makeDatabase(databaseFile, rand, options, targets):
+    # A SQLite stand-in of the tables of the psa database the checks query
+    excluded = set(targets)
+    conn = sqlite3.connect(databaseFile)
+    conn.executescript("""
+        CREATE TABLE misc (param TEXT, val TEXT);
+        CREATE TABLE cp_access (id INTEGER PRIMARY KEY, type TEXT, netaddr TEXT, netmask TEXT);
+    """)
+    conn.executemany('INSERT INTO misc VALUES (?, ?)', [('FullHostName', serverHostname), ('access_policy', 'deny')])
+    rows = []
+    for i in range(options.cp_access):
+        mask = rand.choice(('255.255.255.255', '255.255.255.0', '255.255.0.0'))
+        rows.append(('deny' if i % 5 else 'allow', randomIP(rand, excluded), mask))
+    rows.append(('deny', targets[0], '255.255.255.255'))
+    conn.executemany('INSERT INTO cp_access (type, netaddr, netmask) VALUES (?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+def makePanelIni(rand, options, targets):
+    excluded = set(targets)
+    networks = ['{}/{}'.format(randomIP(rand, excluded), rand.choice((32, 24))) for i in range(options.api_networks)]
+    return '[log]\nfilter.priority = 6\n\n[api]\nallowedIPs = "{}"\n\n[debug]\nenabled = off\n'.format(', '.join(networks + targets[:1]))
+
+def makeBans(rand, options, targets):
+    # The second target is banned in plesk-apache, the third one is in the ignoreip lists
+    excluded = set(targets)
+    bans = dict((jail, [randomIP(rand, excluded) for i in range(options.banned // len(jails))]) for jail in jails)
+    bans['plesk-apache'].append(targets[1])
+    return bans, ['127.0.0.1/8', '::1'] + targets[2:3]
+
+def makeRoot(root, options, targets):
+    rand = Random(options.seed)
+    binDir = join(root, 'bin')
+    logDir = root + '/var/log'
+    for path in (binDir, logDir, root + '/etc/fail2ban', root + '/var/run/fail2ban', root + '/usr/local/psa/admin/conf', root + '/var/lib/360-restrictions-check'):
+        makedirs(path)
+    for name, command in fakeCommands.items():
+        with open(join(binDir, name), 'w') as f:
+            f.write('#!/bin/sh\n' + command + '\n')
+        chmod(join(binDir, name), 0o755)
+
+    if options.firewall == 'nft':
+        iptablesSave, ipsetSave, nftRuleset = '', '', makeNftRuleset(rand, options, targets)
+    else:
+        (iptablesSave, ipsetSave), nftRuleset = makeIptables(rand, options, targets), ''
+    ipAddr = '2: eth0    inet 203.0.113.10/24 brd 203.0.113.255 scope global eth0\\       valid_lft forever preferred_lft forever\n'
+    for name, content in (('iptables-save', iptablesSave), ('ip6tables-save', ''), ('ipset-save', ipsetSave),
+                          ('nft-ruleset.json', nftRuleset), ('ip-addr', ipAddr)):
+        with open(join(root, name), 'w') as f:
+            f.write(content)
+
+    logs, block = makeFail2BanLogs(rand, options, targets, logDir)
+    with open(root + '/etc/fail2ban/jail.local', 'w') as f:
+        f.write('[DEFAULT]\nignoreip = 127.0.0.1/8 ::1 {}\n\n[sshd]\nenabled = true\n'.format(targets[2] if len(targets) > 2 else ''))
+    with open(root + '/usr/local/psa/admin/conf/panel.ini', 'w') as f:
+        f.write(makePanelIni(rand, options, targets))
+    makeDatabase(join(root, 'psa.sqlite'), rand, options, targets)
+    return binDir, {
+        'firewall rules': options.rules,
+        'ipset entries': options.ipsets * options.ipset_size,
+        'ruleset MB': round((len(iptablesSave) + len(ipsetSave) + len(nftRuleset)) / 1048576.0, 1),
+        'log MB': round(sum(getsize(log) for log in logs) / 1048576.0, 1),
+        'logs': len(logs),
+        'cp_access rows': options.cp_access + 1,
+        'api networks': options.api_networks + 1,
+        'targets': len(targets),
+    }, block
+
+
+# ==================
+# Instrumentation
+# ==================
+
+class CountingPopen(subprocess.Popen):
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.count += 1
+        super(CountingPopen, self).__init__(*args, **kwargs)
+
+
+def loadScript(root):
+    # Loads 360-restrictions-check.py as a module with its paths moved into the temporary root
+    with open(scriptFile) as f:
+        source = f.read()
+    for path in rootedPaths:
+        source = source.replace(path, root + path)
+    module = types.ModuleType('restrictionsCheck')
+    module.__file__ = scriptFile
+    exec(compile(source, scriptFile, 'exec'), module.__dict__)
+    return module
+
+
+def currentRSS():
+    # In MB, the second field of statm is the resident size in pages
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1048576.0
+
+
+def measureCheck(check, function, report, options):
+    # Runs in the forked process of the check, ru_maxrss is in kB on Linux
+    baseRSS = currentRSS()
+    CountingPopen.count = 0
+    if options.trace_memory:
+        tracemalloc.start()
+    started = monotonic()
+    check.runCheck(function, report, options.timeout)
+    duration = monotonic() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1048576.0 if options.trace_memory else None
+    if options.trace_memory:
+        tracemalloc.stop()
+    check.resultCache.save([report])
+    return {
+        'status': report.status,
+        'restricted': report.restricted,
+        'cached': report.cached,
+        'wall time': duration,
+        'source': report.details.get('source'),
+        'processes': CountingPopen.count,
+        'peak MB': peak,
+        'RSS growth MB': max(0.0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 - baseRSS),
+        'max RSS of commands MB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+        'messages': [check.ansiPattern.sub('', text).strip() for output, text in report.messages],
+    }
+
+
+def runChecks(check, options):
+    # Every check runs in a forked process which sends its measurements back through a pipe,
+    # the peak RSS of the process comes from the rusage of wait4
+    results = []
+    for name, title, article, function in check.checks:
+        report = check.CheckReport(name, title, article)
+        sys.stdout.flush()
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            try:
+                result = measureCheck(check, function, report, options)
+            except BaseException as e:
+                result = {'status': 'failed', 'messages': ['{}: {}'.format(type(e).__name__, e)]}
+            finally:
+                with os.fdopen(writer, 'w') as f:
+                    json.dump(result, f)
+                os._exit(0)
+        os.close(writer)
+        with os.fdopen(reader) as f:
+            data = f.read()
+        usage = os.wait4(pid, 0)[2]
+        result = {'check': name, 'status': 'failed', 'restricted': False, 'cached': False, 'wall time': 0.0,
+                  'source': None, 'processes': 0, 'peak MB': None, 'RSS growth MB': 0.0, 'max RSS of commands MB': 0.0, 'messages': []}
+        result.update(json.loads(data) if data else {'messages': ['the process of the check exited without a result']})
+        result['max RSS MB'] = usage.ru_maxrss / 1024.0
+        results.append(result)
+    return results
+
+
+def checkFixtures(check, directory = fixturesDir):
+    # Returns the number of the cases whose verdicts differ from the expected ones
+    failed = 0
+    for case in sorted(listdir(directory)):
+        inputs = {}
+        for name in ('iptables-save', 'ipset-save', 'ip6tables-save', 'nft.json', 'ip-addr', 'expected.json'):
+            path = join(directory, case, name)
+            inputs[name] = open(path).read() if exists(path) else None
+        if inputs['expected.json'] is None:
+            continue
+        expected = json.loads(inputs['expected.json'])
+        report = check.CheckReport('firewall')
+        localAddresses = check.parseIpAddr(inputs['ip-addr']) if inputs['ip-addr'] is not None else None
+        check.evaluateFirewall(report, expected['targets'], inputs['iptables-save'] or '', inputs['ipset-save'] or '',
+                               inputs['ip6tables-save'] or '', inputs['nft.json'] or '', '', localAddresses)
+        verdicts = dict((ip, result['verdict']) for ip, result in report.details.get('verdicts', {}).items())
+        differences = ['{}: {} instead of {}'.format(ip, verdicts.get(ip), verdict)
+                       for ip, verdict in sorted(expected['verdicts'].items()) if verdicts.get(ip) != verdict]
+        print('  {:<24} {}'.format(case, 'ok' if not differences else 'FAILED'))
+        for difference in differences:
+            print('      ' + difference)
+        failed += bool(differences)
+    return failed
+
+
+def checkStandIn(server, runs, targets):
+    # Returns the differences between the commands the stand-in got and the ones the Fail2Ban check should send
+    count = len(runs)
+    differences = []
+    expected = [('status', count), ('banned', count), ('status JAIL', count * len(jails) if server.legacy else 0),
+                ('get JAIL ignoreip', count * len(jails))]
+    for name, number in expected:
+        if server.commands[name] != number:
+            differences.append('{} commands "{}" instead of {}'.format(server.commands[name], name, number))
+    if server.roundTrips['get JAIL ignoreip'] != count:
+        differences.append('the ignoreip queries took {} round trips instead of {}'.format(server.roundTrips['get JAIL ignoreip'], count))
+    for results in runs:
+        result = [result for result in results if result['check'] == 'fail2ban'][0]
+        if result['source'] != 'socket':
+            differences.append('the check used the ' + str(result['source']))
+        expectedMessages = ['Fail2Ban bans the IP address {} in the jails: plesk-apache'.format(targets[1]),
+                            'The trusted list of Fail2Ban contains the IP address {}'.format(targets[2])]
+        differences += ['missing: ' + message for message in expectedMessages if message not in result['messages']]
+    return differences
+
+
+def printReport(results, number):
+    print('Run #{}: {:.2f}s'.format(number, sum(result['wall time'] for result in results)))
+    print('  {:<14} {:>9} {:>8} {:>6} {:>10} {:>10} {:>8}  {}'.format('check', 'time', 'status', 'procs', 'peak MB', 'max RSS', '+RSS', 'verdict'))
+    for result in results:
+        verdict = 'restricted' if result['restricted'] else 'clear'
+        print('  {:<14} {:>8.3f}s {:>8} {:>6} {:>10} {:>10.1f} {:>8.1f}  {}{}'.format(
+            result['check'], result['wall time'], result['status'], result['processes'],
+            '-' if result['peak MB'] is None else '{:.1f}'.format(result['peak MB']),
+            result['max RSS MB'], result['RSS growth MB'], verdict, ' (cached)' if result['cached'] else ''))
+        if result['status'] != 'ok':
+            for message in result['messages']:
+                print('      ' + message)
+    print()
+
+
+# ======
+# Main
+# ======
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the checks of 360-restrictions-check.py on synthetic inputs')
+    parser.add_argument('--rules', type=int, default=10000)
+    parser.add_argument('--ipsets', type=int, default=10)
+    parser.add_argument('--ipset-size', type=int, default=10000)
+    parser.add_argument('--firewall', choices=('iptables', 'nft'), default='iptables')
+    parser.add_argument('--log-mb', type=int, default=100)
+    parser.add_argument('--rotated', type=int, default=3)
+    parser.add_argument('--cp-access', type=int, default=10000)
+    parser.add_argument('--api-networks', type=int, default=1000)
+    parser.add_argument('--targets', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=3600, help='how long every check may take, in seconds')
+    parser.add_argument('--seed', type=int, default=360)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--cache', action='store_true', help='keep the results in a cache file in the root')
+    parser.add_argument('--trace-memory', action='store_true', help='report the peak of the memory allocated by every check')
+    parser.add_argument('--fail2ban', choices=('logs', 'socket', 'socket-legacy'), default='logs')
+    parser.add_argument('--banned', type=int, default=10000)
+    parser.add_argument('--json', default=None, help='write the report to the file as well')
+    parser.add_argument('--keep', action='store_true', help='do not remove the temporary root')
+    parser.add_argument('--fixtures', action='store_true', help='only compare the verdicts of the firewall fixtures')
+    options = parser.parse_args()
+
+    if options.fixtures:
+        print('Firewall fixtures in ' + fixturesDir)
+        sys.exit(1 if checkFixtures(loadScript('')) else 0)
+
+    root = mkdtemp(prefix='360-restrictions-bench-')
+    server = None
+    differences = []
+    try:
+        check = loadScript(root)
+        targets = makeTargets(list(check.ipAddresses), options.targets)
+        started = monotonic()
+        binDir, fixture, logBlock = makeRoot(root, options, targets)
+        print('Fixture generated in {:.1f}s, root: {}'.format(monotonic() - started, root))
+        print('  ' + ', '.join('{}: {}'.format(name, value) for name, value in fixture.items()))
+        print()
+        if options.fail2ban != 'logs':
+            bans, ignored = makeBans(Random(options.seed), options, targets)
+            server = Fail2BanStandIn(check.f2bSocketFile, bans, ignored, options.fail2ban == 'socket-legacy')
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        environ.update({'PATH': binDir + pathsep + environ.get('PATH', ''), 'BENCH_ROOT': root})
+        check.ipAddresses[:] = targets
+        check.pleskDB.dsn = 'sqlite://' + join(root, 'psa.sqlite')
+        check.resultCache.path = join(root, 'cache.json') if options.cache else None
+        subprocess.Popen = CountingPopen
+
+        runs = []
+        for number in range(1, options.runs + 1):
+            if number > 1 and options.cache:
+                with open(root + '/var/log/fail2ban.log', 'ab') as log:
+                    log.write(b''.join(logBlock.splitlines(True)[:1000]))
+            results = runChecks(check, options)
+            printReport(results, number)
+            runs.append(results)
+        check.pleskDB.close()
+        if server:
+            differences = checkStandIn(server, runs, targets)
+            print('Fail2Ban stand-in: {} connections, {}'.format(server.connections, ', '.join(
+                '{} "{}" in {} round trips'.format(number, name, server.roundTrips[name]) for name, number in sorted(server.commands.items()))))
+            for difference in differences:
+                print('  ' + difference)
+            print()
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if not options.keep:
+            rmtree(root)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'options': vars(options), 'fixture': fixture, 'runs': runs,
+                       'fail2ban stand-in': server and {'connections': server.connections, 'commands': server.commands,
+                                                        'round trips': server.roundTrips, 'differences': differences}}, f, indent=2)
+    if differences:
+        sys.exit(1)
@@ -4,74 +4,954 @@
 ###############################################################################
 # This script helps to check whether there are any restriction to add a server to Plesk 360
 # Requirements : Python 2.7 or 3.x
-# Version      : 1.1
+# Version      : 1.10
+#
+# Usage        : 360-restrictions-check.py [--json FILE] [--timeout SECONDS] [--cloudflare-probe]
+#                                          [--update-cloudflare-ranges] [--db-dsn DSN]
+#                                          [--cache-file FILE] [--no-cache]
+#   --json    : write the results of the checks in JSON to FILE ('-' to print
+#               them to stdout instead of the text)
+#   --timeout : how long every check may take (default: 60 seconds). The checks
+#               run at the same time, a check which does not finish in time is
+#               reported as timed out and its commands are killed
+#   --cloudflare-probe         : confirm the Cloudflare check with an HTTP request
+#                                to every address of the server hostname
+#   --update-cloudflare-ranges : download the current networks of Cloudflare to
+#                                /var/lib/360-restrictions-check/cloudflare-ranges
+#                                and exit. The bundled networks are used until then
+#   --db-dsn                   : query a stand-in of the psa database instead, e.g.
+#                                sqlite:///tmp/psa.sqlite. By default one connection to
+#                                the psa database is shared by all the checks, it is
+#                                opened with pymysql or MySQLdb. The mysql client is
+#                                used when neither of them is installed
+#   --cache-file               : the file to keep the results of the checks in (default:
+#                                /var/lib/360-restrictions-check/cache.json). The firewall,
+#                                Fail2Ban and API checks return the saved result when the
+#                                ruleset, the logs or panel.ini did not change. When the
+#                                Fail2Ban log only grew, just the new lines are scanned
+#   --no-cache                 : run all the checks without the saved results
+#
+# Nothing is run when the script is imported. The evaluate* functions take the
+# collected inputs and the IP addresses to check and fill a CheckReport:
+#   evaluateFirewall     : the outputs of iptables-save, ipset save, ip6tables-save
+#                          and nft -j list ruleset and the addresses of the server.
+#                          The verdict is UNDETERMINED when it depends on a rule
+#                          which cannot be evaluated, like a rate limit
+#   evaluateFail2BanLogs : the lines of the Fail2Ban logs and of jail.local
+#   evaluateAdminAccess  : the rows of cp_access and the access policy
+#   evaluateApi          : the content of panel.ini
+#   evaluateCloudflare   : the hostname and its addresses, from the public DNS unless
+#                          only a local mapping in /etc/hosts was available
+# For example, with Python 3:
+#   spec = importlib.util.spec_from_file_location('restrictionsCheck', '360-restrictions-check.py')
+#   check = importlib.util.module_from_spec(spec)
+#   spec.loader.exec_module(check)
+#   report = check.CheckReport('api')
+#   check.evaluateApi(report, ['203.0.113.1'], panelIni)
+#   report.toDict()
 #########
 
+import argparse
+import binascii
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import pickle
+import re
+import shlex
+import signal
+import socket
 import subprocess
 import sys
+import threading
+import time
+
+try:
+	from urllib.request import urlopen
+except ImportError:
+	from urllib2 import urlopen
 
 ipAddresses = ['52.51.23.204', '52.213.169.7', '34.254.37.129']
+firewallPort = 8443
+defaultTimeout = 60
+panelIniFile = '/usr/local/psa/admin/conf/panel.ini'
+
+# Define functions to match IP addresses against networks
+def ipToInt(ip):
+	# Returns the bit length of the address family and the address as an integer
+	ip = ip.strip()
+	if ':' in ip:
+		return 128, int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, ip.split('%')[0])), 16)
+	return 32, int(binascii.hexlify(socket.inet_pton(socket.AF_INET, ip)), 16)
+
+def maskToPrefix(mask, bits):
+	# Accepts both a prefix length and a netmask like 255.255.255.0
+	mask = str(mask).strip()
+	if '.' in mask or ':' in mask:
+		return bin(ipToInt(mask)[1]).count('1')
+	prefix = int(mask)
+	if not 0 <= prefix <= bits:
+		raise ValueError('Invalid prefix length: ' + mask)
+	return prefix
+
+def parseNetwork(network, mask = None):
+	# Returns the bit length of the address family, the network part of the address and the prefix length
+	network = network.strip()
+	if '/' in network:
+		network, mask = network.split('/', 1)
+	bits, value = ipToInt(network)
+	prefix = bits if mask is None else maskToPrefix(mask, bits)
+	return bits, value >> (bits - prefix), prefix
+
+class NetworkMatcher(object):
+	# The networks are compiled once into a hash table per address family and prefix length,
+	# so an address is matched against all of them with one lookup per prefix length in use
+	def __init__(self):
+		self.tables = {32: {}, 128: {}}
+		self.prefixes = {32: [], 128: []}
+
+	def add(self, network, rule, mask = None):
+		bits, value, prefix = parseNetwork(network, mask)
+		self.addPrefix(bits, value, prefix, rule)
+
+	def addRange(self, first, last, rule):
+		# Splits the range of addresses into the largest aligned networks
+		bits, start = ipToInt(first)
+		end = ipToInt(last)[1]
+		while start <= end:
+			size = 0
+			while size < bits and start % (2 << size) == 0 and start + (2 << size) - 1 <= end:
+				size += 1
+			self.addPrefix(bits, start >> size, bits - size, rule)
+			start += 1 << size
+
+	def addPrefix(self, bits, value, prefix, rule):
+		table = self.tables[bits].get(prefix)
+		if table is None:
+			table = self.tables[bits][prefix] = {}
+			self.prefixes[bits] = sorted(self.tables[bits])
+		rules = table.get(value)
+		if rules is None:
+			table[value] = [rule]
+		else:
+			rules.append(rule)
+
+	def match(self, ip):
+		# Returns the rules of all the networks which contain the address, from the shortest prefix
+		try:
+			bits, value = ipToInt(ip)
+		except (socket.error, ValueError):
+			return []
+		tables = self.tables[bits]
+		found = []
+		for prefix in self.prefixes[bits]:
+			rules = tables[prefix].get(value >> (bits - prefix))
+			if rules:
+				found.extend(rules)
+		return found
+
+	def matchMany(self, ips):
+		return dict((ip, self.match(ip)) for ip in ips)
+
+def compileNetworks(networks, masks = None):
+	# Builds a matcher where every network is identified by its position in the list, invalid networks are skipped
+	matcher = NetworkMatcher()
+	for index, network in enumerate(networks):
+		try:
+			matcher.add(network, index, masks[index] if masks else None)
+		except (socket.error, ValueError):
+			pass
+	return matcher
+
+
+# Define functions to evaluate firewall rules
+# A rule is evaluated for a new TCP connection to port 8443 from the checked IP address,
+# arriving on any interface except the loopback one and addressed to one of the global
+# addresses of the server. A rule with a match which cannot be evaluated for such a
+# connection (rate limits, recent lists, etc.) makes the verdict undetermined when it
+# would change the verdict
+terminalTargets = {'ACCEPT': 'ACCEPT', 'DROP': 'DROP', 'REJECT': 'REJECT', 'TARPIT': 'DROP'}
+singleArgOptions = ('--comment', '--log-prefix', '--nflog-prefix')
+tcpFlags = ('FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG', 'ECE', 'CWR')
+stringTypes = (str, type(u''))
+
+def portMatches(spec, port = firewallPort):
+	# Accepts the port lists and ranges of iptables, ipset and nftables: 8443, 8000:9000, 80,443,8000-9000
+	for item in str(spec).split(','):
+		low, separator, high = item.strip().replace('-', ':').partition(':')
+		try:
+			low = int(low or 0)
+			high = int(high or 65535) if separator else low
+		except ValueError:
+			try:
+				low = high = socket.getservbyname(item.strip(), 'tcp')
+			except socket.error:
+				continue
+		if low <= port <= high:
+			return True
+	return False
+
+class IpSet(object):
+	# The single addresses are kept in hash sets of integers like the sets of the kernel,
+	# only the networks, the ranges and the entries with ports go to a network matcher
+	def __init__(self, name, setType = 'hash:ip', registry = None):
+		self.name = name
+		self.type = setType
+		self.registry = registry if registry is not None else {}
+		self.addresses = {32: set(), 128: set()}
+		self.networks = NetworkMatcher()
+		self.members = []
+
+	def addEntry(self, entry):
+		if self.type.startswith('list:'):
+			self.members.append(entry)
+			return
+		parts = entry.split(',')
+		# The port of hash:ip,port and similar types is kept as the rule of the network
+		port = None
+		for part in parts[1:]:
+			protocol, separator, value = part.rpartition(':')
+			if value.replace('-', '').isdigit():
+				port = value if protocol in ('', 'tcp') else ''
+		if '-' in parts[0] and '/' not in parts[0]:
+			first, last = parts[0].split('-', 1)
+			self.networks.addRange(first, last, port)
+			return
+		bits, value, prefix = parseNetwork(parts[0])
+		if prefix == bits and port is None:
+			self.addresses[bits].add(value)
+		else:
+			self.networks.addPrefix(bits, value, prefix, port)
+
+	def match(self, ip):
+		try:
+			bits, value = ipToInt(ip)
+		except (socket.error, ValueError):
+			return False
+		if value in self.addresses[bits]:
+			return True
+		for port in self.networks.match(ip):
+			if port is None or (port and portMatches(port)):
+				return True
+		return any(member in self.registry and self.registry[member].match(ip) for member in self.members)
+
+def parseIpsetSave(text):
+	# Parses the output of "ipset save" into the sets keyed by their names
+	ipsets = {}
+	for line in text.splitlines():
+		tokens = line.split()
+		if len(tokens) >= 3 and tokens[0] == 'create':
+			ipsets[tokens[1]] = IpSet(tokens[1], tokens[2], ipsets)
+		elif len(tokens) >= 3 and tokens[0] == 'add' and tokens[1] in ipsets:
+			try:
+				ipsets[tokens[1]].addEntry(tokens[2])
+			except (socket.error, ValueError):
+				pass
+	return ipsets
+
+class FirewallChain(object):
+	# The rules with a single source network are indexed in a network matcher, a hash table per prefix
+	# length, so only the rules which can match the source address are visited, in their original order
+	def __init__(self, name, policy = None):
+		self.name = name
+		self.policy = policy
+		self.rules = []
+		self.index = NetworkMatcher()
+		self.unindexed = []
+
+	def addRule(self, rule):
+		number = len(self.rules)
+		self.rules.append(rule)
+		if not rule['applies']:
+			return False
+		try:
+			if rule['network']:
+				self.index.add(rule['network'], number)
+				return True
+		except (socket.error, ValueError):
+			return False
+		self.unindexed.append(number)
+		return True
 
-# Define functions to calculate IP addresses and subnets
-def ipConvert(ip):
-	octets = ip.split('.')
-	binOctets = '{0:08b}'.format(int(octets[0])) + '{0:08b}'.format(int(octets[1])) + '{0:08b}'.format(int(octets[2])) + '{0:08b}'.format(int(octets[3]))
-	return binOctets
-
-def calculateCIDR(mask):
-	convertedMask = ipConvert(mask)
-	cidr = convertedMask.count('1')
-	return cidr
-
-def startIP(range):
-	if '/' in range:
-		ip = range.split('/')[0]
-		mask = range.split('/')[1]
-	else:
-		ip = range
-		mask = '32'
-	sIP = ipConvert(ip)[:int(mask)] + '0' * (32 - int(mask))
-	return sIP
-
-def endIP(range):
-	if '/' in range:
-		ip = range.split('/')[0]
-		mask = range.split('/')[1]
+	def candidates(self, ip):
+		found = set(self.index.match(ip))
+		for number in self.unindexed:
+			if all(bool(matcher.match(ip)) != negate for negate, matcher in self.rules[number]['checks']):
+				found.add(number)
+		return sorted(found)
+
+class Firewall(object):
+	# The destination matches are evaluated against the local addresses, with None they are undetermined
+	def __init__(self, localAddresses = None):
+		self.chains = {}
+		self.baseChains = []
+		self.applicable = 0
+		self.localAddresses = None
+		if localAddresses is not None:
+			self.localAddresses = {32: [], 128: []}
+			for address in localAddresses:
+				try:
+					self.localAddresses[ipToInt(address)[0]].append(address)
+				except (socket.error, ValueError):
+					pass
+
+	def addChain(self, name, policy = None):
+		if name not in self.chains:
+			self.chains[name] = FirewallChain(name, policy)
+		elif policy:
+			self.chains[name].policy = policy
+		return self.chains[name]
+
+	def addBaseChain(self, name, families, priority = 0):
+		self.baseChains.append((priority, len(self.baseChains), name, families))
+		self.baseChains.sort()
+
+	def addRule(self, chainName, rule):
+		if self.addChain(chainName).addRule(rule):
+			self.applicable += 1
+
+	def ruleState(self, rule, bits):
+		# Returns True when the rule matches the connections of the address family, False when
+		# it does not match them and None when it cannot be determined
+		if bits not in rule['state']:
+			state = bits in rule['families']
+			for negate, matcher in rule['destinations'] if state else []:
+				addresses = self.localAddresses[bits] if self.localAddresses is not None else []
+				found = set(bool(matcher.match(address)) != negate for address in addresses)
+				if found == set([False]):
+					state = False
+					break
+				if found != set([True]):
+					state = None
+			if state and rule['unknown']:
+				state = None
+			rule['state'][bits] = state
+		return rule['state'][bits]
+
+	def walk(self, chainName, ip, uncertain, depth = 0):
+		# Returns the verdict and the rule of the first terminal match, or None when the chain returns.
+		# The verdicts of the rules which may or may not match are added to uncertain
+		chain = self.chains.get(chainName)
+		if chain is None or depth > 64:
+			return None, None
+		bits = ipToInt(ip)[0]
+		for number in chain.candidates(ip):
+			rule = chain.rules[number]
+			state = self.ruleState(rule, bits)
+			if state is False:
+				continue
+			if rule['target'] in terminalTargets or rule['target'] == 'RETURN':
+				if state is None:
+					uncertain.append((terminalTargets.get(rule['target'], 'RETURN'), rule))
+				elif rule['target'] == 'RETURN':
+					return None, None
+				else:
+					return terminalTargets[rule['target']], rule
+			elif rule['jump'] in self.chains:
+				verdict, matched = self.walk(rule['jump'], ip, uncertain, depth + 1)
+				if state is None and (verdict or rule['goto']):
+					uncertain.append((verdict or 'RETURN', matched or rule))
+				elif verdict or rule['goto']:
+					return verdict, matched
+		return None, None
+
+	def evaluate(self, ip):
+		# A connection has to be accepted by all the input base chains of its address family. The verdict
+		# is UNDETERMINED with the first rule which could change it when a later chain does not reject it
+		bits = ipToInt(ip)[0]
+		verdict, matched, undetermined = 'ACCEPT', None, None
+		for priority, order, name, families in self.baseChains:
+			if bits not in families:
+				continue
+			uncertain = []
+			verdict, matched = self.walk(name, ip, uncertain)
+			if verdict is None:
+				verdict, matched = (self.chains[name].policy or 'ACCEPT').upper(), None
+			doubtful = [rule for other, rule in uncertain if other == 'RETURN' or (other == 'ACCEPT') != (verdict == 'ACCEPT')]
+			if doubtful:
+				undetermined = undetermined or doubtful[0]
+			elif verdict != 'ACCEPT':
+				return verdict, matched
+		if undetermined:
+			return 'UNDETERMINED', undetermined
+		return verdict, matched
+
+	def evaluateMany(self, ips):
+		return dict((ip, self.evaluate(ip)) for ip in ips)
+
+def newRule(text):
+	# The checks match the source address, the destinations the local addresses and unknown lists the matches which cannot be evaluated
+	return {'text': text, 'target': None, 'jump': None, 'goto': False, 'checks': [], 'network': None, 'applies': True,
+		'destinations': [], 'families': (32, 128), 'unknown': [], 'state': {}}
+
+def finishRule(rule):
+	# A rule with only one source network goes to the index of the chain
+	if len(rule['checks']) == 1 and not rule['checks'][0][0] and rule['checks'][0][2]:
+		rule['network'] = rule['checks'][0][2]
+	rule['checks'] = [(negate, matcher) for negate, matcher, network in rule['checks']]
+	return rule
+
+def rangeMatcher(value):
+	# Returns a matcher of a range of addresses like 10.0.0.1-10.0.0.5, or None when it is invalid
+	matcher = NetworkMatcher()
+	try:
+		first, last = value.split('-', 1)
+		matcher.addRange(first, last, True)
+	except (socket.error, ValueError):
+		return None
+	return matcher
+
+def flagsMatch(mask, compare):
+	# The connection is opened by a packet with only the SYN flag set
+	mask = set(tcpFlags if mask.upper() == 'ALL' else mask.upper().split(','))
+	compare = set(tcpFlags if compare.upper() == 'ALL' else compare.upper().split(',')) - set(['NONE'])
+	return mask & set(['SYN']) == compare
+
+def applyIptablesOption(rule, option, args, negate, ipsets, prefix):
+	value = args[0] if args else ''
+	if option in ('-s', '--source'):
+		rule['checks'].append((negate, compileNetworks([value]), value))
+	elif option in ('-d', '--destination'):
+		rule['destinations'].append((negate, compileNetworks([value])))
+	elif option in ('--src-range', '--dst-range') and rangeMatcher(value):
+		if option == '--src-range':
+			rule['checks'].append((negate, rangeMatcher(value), None))
+		else:
+			rule['destinations'].append((negate, rangeMatcher(value)))
+	elif option in ('-p', '--protocol'):
+		rule['applies'] &= (value.lower() in ('tcp', '6', 'all', '0')) != negate
+	elif option in ('-i', '--in-interface'):
+		rule['applies'] &= value != 'lo' or negate
+	elif option in ('--dport', '--dports', '--destination-port', '--destination-ports'):
+		rule['applies'] &= portMatches(value) != negate
+	elif option in ('--sport', '--sports', '--source-port', '--source-ports', '-f', '--fragment'):
+		rule['applies'] &= negate
+	elif option in ('--state', '--ctstate'):
+		rule['applies'] &= ('NEW' in value.upper().split(',')) != negate
+	elif option == '--ctstatus':
+		rule['applies'] &= ('NONE' in value.upper().split(',')) != negate
+	elif option == '--syn':
+		rule['applies'] &= not negate
+	elif option == '--tcp-flags' and len(args) > 1:
+		rule['applies'] &= flagsMatch(args[0], args[1]) != negate
+	elif option in ('-o', '--out-interface', '--icmp-type', '--icmpv6-type'):
+		rule['applies'] &= negate
+	elif option == '--pkt-type':
+		rule['applies'] &= (value.lower() == 'unicast') != negate
+	elif option in ('--src-type', '--dst-type'):
+		rule['applies'] &= (('LOCAL' if option == '--dst-type' else 'UNICAST') in value.upper().split(',')) != negate
+	elif option == '--match-set' and len(args) > 1:
+		ipset = ipsets.get(value) or IpSet(value)
+		if args[1].startswith('src'):
+			rule['checks'].append((negate, ipset, None))
+		else:
+			rule['destinations'].append((negate, ipset))
+	elif option in ('-j', '--jump', '-g', '--goto'):
+		rule['target'] = value
+		rule['jump'] = prefix + value
+		rule['goto'] = option in ('-g', '--goto')
+	elif option not in ('-m', '--match', '--comment'):
+		rule['unknown'].append(' '.join(['!'] * negate + [option] + args))
+
+def parseIptablesRule(line, ipsets, prefix = ''):
+	tokens = shlex.split(line)
+	rule = newRule(line)
+	position = 2
+	negate = False
+	while position < len(tokens):
+		option = tokens[position]
+		position += 1
+		if option == '!':
+			negate = True
+			continue
+		args = []
+		if option in singleArgOptions:
+			args = tokens[position:position + 1]
+			position += 1
+		else:
+			while position < len(tokens) and tokens[position] != '!' and not tokens[position].startswith('-'):
+				args.append(tokens[position])
+				position += 1
+		# The options after the target belong to the target
+		if rule['target'] is None:
+			applyIptablesOption(rule, option, args, negate, ipsets, prefix)
+		negate = False
+	return prefix + tokens[1], finishRule(rule)
+
+def parseIptablesSave(text, ipsets = None, firewall = None, bits = 32):
+	# Parses the filter table of the output of "iptables-save" or "ip6tables-save"
+	firewall = firewall or Firewall()
+	prefix = '' if bits == 32 else 'ip6 '
+	table = None
+	for line in text.splitlines():
+		line = line.strip()
+		if line.startswith('*'):
+			table = line[1:]
+		elif table != 'filter' or not line or line.startswith('#'):
+			continue
+		elif line.startswith(':'):
+			name, policy = (line[1:].split() + ['-'])[:2]
+			firewall.addChain(prefix + name, None if policy == '-' else policy)
+			if name == 'INPUT':
+				firewall.addBaseChain(prefix + name, (bits,))
+		elif line.startswith('-A '):
+			chainName, rule = parseIptablesRule(line, ipsets or {}, prefix)
+			firewall.addRule(chainName, rule)
+	return firewall
+
+nftFamilies = {'ip': (32,), 'ip6': (128,), 'inet': (32, 128)}
+
+def nftElements(value):
+	# Flattens the values, anonymous sets and set elements of nftables JSON into a list
+	if isinstance(value, list):
+		return [item for element in value for item in nftElements(element)]
+	if isinstance(value, dict) and 'set' in value:
+		return nftElements(value['set'])
+	if isinstance(value, dict) and 'elem' in value:
+		return nftElements(value['elem'].get('val'))
+	return [value]
+
+def addNftAddress(matcher, value, rule = None):
+	if isinstance(value, dict) and 'prefix' in value:
+		matcher.add(value['prefix']['addr'], rule, value['prefix']['len'])
+	elif isinstance(value, dict) and 'range' in value:
+		matcher.addRange(value['range'][0], value['range'][1], rule)
+	elif not isinstance(value, dict):
+		matcher.add(str(value), rule)
+
+def nftPortMatches(value, sets, setPrefix):
+	for element in nftElements(value):
+		if isinstance(element, dict) and 'range' in element:
+			if int(element['range'][0]) <= firewallPort <= int(element['range'][1]):
+				return True
+		elif isinstance(element, stringTypes) and element.startswith('@'):
+			if nftPortMatches(sets.get(setPrefix + element[1:], []), sets, setPrefix):
+				return True
+		elif portMatches(element):
+			return True
+	return False
+
+def nftNetwork(value):
+	# Returns a single network as a string, or None for sets and ranges
+	if isinstance(value, dict) and 'prefix' in value:
+		return '{}/{}'.format(value['prefix']['addr'], value['prefix']['len'])
+	if isinstance(value, stringTypes) and not value.startswith('@'):
+		return value
+	return None
+
+nftStatements = ('counter', 'log', 'mangle', 'notrack', 'set')
+nftFamilyNames = {'ipv4': 32, 'ipv6': 128}
+
+def nftAddressMatcher(value, sets, setPrefix):
+	if isinstance(value, stringTypes) and value.startswith('@'):
+		return sets.get(setPrefix + value[1:]) or IpSet(value[1:])
+	matcher = NetworkMatcher()
+	for element in nftElements(value):
+		try:
+			addNftAddress(matcher, element, True)
+		except (socket.error, ValueError):
+			pass
+	return matcher
+
+def applyNftMatch(rule, left, right, negate, sets, setPrefix):
+	kind = [name for name in ('payload', 'meta', 'ct', 'fib') if isinstance(left, dict) and isinstance(left.get(name), dict)]
+	key = left[kind[0]] if kind else {}
+	field = key.get('field') or key.get('key') or key.get('result')
+	values = [str(element).lower() for element in nftElements(right)]
+	if 'payload' in kind and field in ('saddr', 'daddr') and key.get('protocol') in ('ip', 'ip6'):
+		if field == 'saddr':
+			rule['checks'].append((negate, nftAddressMatcher(right, sets, setPrefix), nftNetwork(right)))
+		else:
+			rule['destinations'].append((negate, nftAddressMatcher(right, sets, setPrefix)))
+	elif 'payload' in kind and field == 'dport':
+		rule['applies'] &= (key.get('protocol') in ('tcp', 'th') and nftPortMatches(right, sets, setPrefix)) != negate
+	elif 'payload' in kind and field == 'sport':
+		rule['applies'] &= negate
+	elif 'payload' in kind and field == 'flags' and key.get('protocol') == 'tcp':
+		rule['applies'] &= ('syn' in values) != negate
+	elif ('payload' in kind and field in ('protocol', 'nexthdr')) or ('meta' in kind and field == 'l4proto'):
+		rule['applies'] &= ('tcp' in values or '6' in values) != negate
+	elif 'meta' in kind and field in ('iifname', 'iif'):
+		rule['applies'] &= values != ['lo'] or negate
+	elif 'meta' in kind and field in ('oifname', 'oif'):
+		rule['applies'] &= negate
+	elif 'meta' in kind and field == 'nfproto':
+		rule['families'] = tuple(bits for bits in rule['families'] if ([name for name in values if nftFamilyNames.get(name) == bits] != []) != negate)
+	elif 'meta' in kind and field == 'pkttype':
+		rule['applies'] &= ('unicast' in values) != negate
+	elif 'ct' in kind and field == 'state':
+		rule['applies'] &= ('new' in values) != negate
+	elif 'ct' in kind and field == 'status':
+		# A new connection from outside is not translated, confirmed or expected
+		rule['applies'] &= negate
+	elif 'fib' in kind and field == 'type':
+		rule['applies'] &= (('local' if 'daddr' in key.get('flags', []) else 'unicast') in values) != negate
+	elif 'fib' in kind and field in ('oif', 'oifname') and 'saddr' in key.get('flags', []) and isinstance(right, bool):
+		# The reverse path lookup of the source address finds an interface
+		rule['applies'] &= right != negate
 	else:
-		ip = range
-		mask = '32'
-	eIP = ipConvert(ip)[:int(mask)] + '1' * (32 - int(mask))
-	return eIP
-
-def checkIpInSubnet(ip, start, end):
-	if int(start, 2) <= int(ip, 2) <= int(end, 2):
+		rule['unknown'].append(' '.join([kind[0], str(field)]) if kind else json.dumps(left, sort_keys = True))
+
+def applyNftVerdict(rule, expression, setPrefix):
+	for verdict in ('accept', 'drop', 'reject', 'return'):
+		if verdict in expression:
+			rule['target'] = verdict.upper()
+			return True
+	if 'jump' in expression or 'goto' in expression:
+		rule['goto'] = 'goto' in expression
+		rule['target'] = (expression.get('jump') or expression.get('goto'))['target']
+		rule['jump'] = setPrefix + rule['target']
 		return True
-	else:
-		return False
-
-
-# Define functions to find and compare elements
-def checkIfInList(list, itemone, itemtwo):
-	result = False
-	for sublist in list:
-		if itemone in sublist:
-			if itemtwo in sublist:
-				result = True
-				break
-	return result
-
-def getPosition(list, itemone, itemtwo):
-	for sublist in list:
-		if itemone in sublist:
-			if itemtwo in sublist:
-				return str(list.index(sublist)) + " " + str(sublist.index(itemtwo))
+	return False
+
+def nftMapVerdict(rule, vmap, sets, setPrefix):
+	# Returns the verdict of the element of a verdict map which matches the connection, or None.
+	# When the elements cannot be evaluated the first one which does not accept is returned
+	elements = vmap.get('data')
+	elements = elements.get('set') if isinstance(elements, dict) else elements
+	if not isinstance(elements, list):
+		rule['unknown'].append('vmap ' + str(elements))
+		return {'drop': None}
+	verdicts = []
+	for element in elements:
+		if not isinstance(element, list) or len(element) != 2:
+			continue
+		probe = newRule('')
+		applyNftMatch(probe, vmap.get('key'), element[0], False, sets, setPrefix)
+		if probe['checks'] or probe['destinations'] or probe['unknown']:
+			verdicts.append(element[1])
+		elif probe['applies'] and not verdicts:
+			return element[1]
+	if verdicts:
+		rule['unknown'].append('vmap')
+		return ([verdict for verdict in verdicts if isinstance(verdict, dict) and 'accept' not in verdict] + verdicts)[0]
+	return None
+
+def parseNftRule(entry, sets):
+	setPrefix = '{} {} '.format(entry['family'], entry['table'])
+	rule = newRule('{}{} handle {}'.format(setPrefix, entry['chain'], entry.get('handle')))
+	for expression in entry.get('expr', []):
+		if 'match' in expression:
+			match = expression['match']
+			applyNftMatch(rule, match.get('left'), match.get('right'), match.get('op') == '!=', sets, setPrefix)
+		elif 'vmap' in expression:
+			verdict = nftMapVerdict(rule, expression['vmap'], sets, setPrefix)
+			if not isinstance(verdict, dict) or not applyNftVerdict(rule, verdict, setPrefix):
+				rule['applies'] = False
+			break
+		elif applyNftVerdict(rule, expression, setPrefix):
+			break
+		elif not [statement for statement in nftStatements if statement in expression]:
+			rule['unknown'].append(sorted(expression)[0] if isinstance(expression, dict) and expression else str(expression))
+	return setPrefix + entry['chain'], finishRule(rule)
+
+# iptables-nft keeps its rules in these tables, they are already read from the output of iptables-save
+iptablesNftTables = (('ip', 'filter'), ('ip6', 'filter'))
+
+def parseNftRuleset(text, firewall = None, skipTables = ()):
+	# Parses the output of "nft -j list ruleset", the chains of the skipped tables are left out
+	firewall = firewall or Firewall()
+	objects = json.loads(text).get('nftables', [])
+	sets = {}
+	for item in objects:
+		if 'set' in item and item['set'].get('family') in nftFamilies:
+			nftSet = item['set']
+			setName = '{} {} {}'.format(nftSet['family'], nftSet['table'], nftSet['name'])
+			if 'addr' in str(nftSet.get('type')):
+				sets[setName] = IpSet(nftSet['name'], 'hash:net')
+				for element in nftElements(nftSet.get('elem', [])):
+					try:
+						if isinstance(element, dict):
+							addNftAddress(sets[setName].networks, element)
+						else:
+							sets[setName].addEntry(str(element))
+					except (socket.error, ValueError):
+						pass
+			else:
+				sets[setName] = nftSet.get('elem', [])
+		elif 'chain' in item and item['chain'].get('family') in nftFamilies:
+			chain = item['chain']
+			if (chain['family'], chain['table']) in skipTables:
+				continue
+			name = '{} {} {}'.format(chain['family'], chain['table'], chain['name'])
+			firewall.addChain(name, chain.get('policy', 'accept').upper() if chain.get('hook') else None)
+			if chain.get('hook') == 'input' and chain.get('type', 'filter') == 'filter':
+				firewall.addBaseChain(name, nftFamilies[chain['family']], chain.get('prio', 0))
+	for item in objects:
+		if 'rule' in item and item['rule'].get('family') in nftFamilies:
+			if (item['rule']['family'], item['rule']['table']) in skipTables:
+				continue
+			chainName, rule = parseNftRule(item['rule'], sets)
+			firewall.addRule(chainName, rule)
+	return firewall
+
+
+# Define functions to scan the Fail2Ban logs
+f2bLogFile = '/var/log/fail2ban.log'
+f2bJailFile = '/etc/fail2ban/jail.local'
+f2bEventPattern = re.compile(r'\[([^\]]+)\]\s+(?:Restore\s+)?(Ban|Unban)\s+(\S+)')
+ipTokenPattern = re.compile(r'(?<![\w.:])(?:\d{1,3}(?:\.\d{1,3}){3}|[0-9a-fA-F]{0,4}(?::[0-9a-fA-F]{0,4}){2,7})(?![\w.:])')
+
+def rotationOrder(path, logFile = f2bLogFile):
+	# The current log goes last, the rotated logs go from the oldest to the newest:
+	# fail2ban.log.3.gz, fail2ban.log.2.gz, fail2ban.log.1 or fail2ban.log-20240101.gz, fail2ban.log-20240108
+	suffix = path[len(logFile) + 1:].replace('.gz', '')
+	if not suffix:
+		return (2, 0, '')
+	if suffix.isdigit():
+		return (0, -int(suffix), '')
+	return (1, 0, suffix)
+
+def findFail2BanLogs(logFile = f2bLogFile):
+	return sorted([path for path in glob.glob(logFile + '*') if path == logFile or path[len(logFile)] in '.-'], key=lambda path: rotationOrder(path, logFile))
+
+def readLogLines(paths):
+	# Yields the lines of the plain and the compressed logs one by one, so the logs are never loaded into memory
+	for path in paths:
+		if path.endswith('.gz'):
+			logFile = io.TextIOWrapper(io.BufferedReader(gzip.open(path, 'rb')), encoding='utf-8', errors='replace')
+		else:
+			logFile = io.open(path, encoding='utf-8', errors='replace')
+		with logFile:
+			for line in logFile:
+				yield line
+
+def scanFail2BanLog(lines, targets, records = None, bans = None):
+	# Returns how many records there are about every IP address and the jails which still ban it
+	# after replaying the Ban and Unban events in the order they were logged, from the given state if any
+	targets = set(targets)
+	records = dict((ip, (records or {}).get(ip, 0)) for ip in targets)
+	bans = dict((ip, set((bans or {}).get(ip, ()))) for ip in targets)
+	for line in lines:
+		found = [ip for ip in ipTokenPattern.findall(line) if ip in targets]
+		if not found:
+			continue
+		for ip in found:
+			records[ip] += 1
+		event = f2bEventPattern.search(line)
+		if event and event.group(3) in targets:
+			if event.group(2) == 'Ban':
+				bans[event.group(3)].add(event.group(1))
+			else:
+				bans[event.group(3)].discard(event.group(1))
+	return records, bans
+
+def readLogFrom(path, offset, position):
+	# Yields the complete lines of the log from the offset, position[0] is moved to the end of the last of them
+	position[0] = offset
+	with open(path, 'rb') as logFile:
+		logFile.seek(offset)
+		for line in logFile:
+			if not line.endswith(b'\n'):
 				break
-
-def comparePositions(first, second):
-	if int(first.split()[0]) < int(second.split()[0]):
-		return True
+			position[0] += len(line)
+			yield line.decode('utf-8', 'replace')
+
+def scanFail2BanLogs(paths, targets, cache = None, logFile = f2bLogFile):
+	# Only the lines added to the current log since the previous run are scanned when the rotated logs
+	# did not change and the current log is the same file, the saved state is replayed further from there
+	current = logFile if logFile in paths else None
+	rotated = [path for path in paths if path != current]
+	signatures = [[path, fileSignature(path)] for path in rotated]
+	previous = cache.get('fail2banScan') if cache else None
+	records = bans = None
+	position = [0]
+	if current:
+		currentStat = os.stat(current)
+		if previous and previous['rotated'] == signatures and previous['inode'] == currentStat.st_ino and previous['offset'] <= currentStat.st_size:
+			records = previous['records']
+			bans = dict((ip, set(jails)) for ip, jails in previous['bans'].items())
+			lines = readLogFrom(current, previous['offset'], position)
+		else:
+			lines = itertools.chain(readLogLines(rotated), readLogFrom(current, 0, position))
 	else:
-		return False
+		lines = readLogLines(rotated)
+	records, bans = scanFail2BanLog(lines, targets, records, bans)
+	if cache and current:
+		cache.set('fail2banScan', {'rotated': signatures, 'inode': currentStat.st_ino, 'offset': position[0],
+								   'records': records, 'bans': dict((ip, sorted(bans[ip])) for ip in bans)})
+	return records, bans
+
+def parseIgnoredNetworks(lines):
+	# Returns the networks of the ignoreip options of the jails
+	networks = []
+	for line in lines:
+		option, separator, value = line.partition('=')
+		if separator and option.strip() == 'ignoreip':
+			networks.extend(value.replace(',', ' ').split())
+	return compileNetworks(networks)
+
+def readIgnoredNetworks(jailFile = f2bJailFile):
+	if not os.path.isfile(jailFile):
+		return compileNetworks([])
+	with io.open(jailFile, encoding='utf-8', errors='replace') as jails:
+		return parseIgnoredNetworks(jails)
+
+
+# Define functions to query the Fail2Ban server through its control socket
+f2bSocketFile = '/var/run/fail2ban/fail2ban.sock'
+f2bEndCommand = b'<F2B_END_COMMAND>'
+f2bCloseCommand = b'<F2B_CLOSE_COMMAND>'
+
+class Fail2BanClient(object):
+	# Speaks the protocol of fail2ban-client: pickled commands and responses separated by the end marker.
+	# Several commands are sent at once and their responses are read in the same order
+	def __init__(self, socketFile = f2bSocketFile, timeout = 5):
+		self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.conn.settimeout(timeout)
+		self.buffer = b''
+		try:
+			self.conn.connect(socketFile)
+		except socket.error:
+			self.conn.close()
+			raise
+
+	def receive(self):
+		while f2bEndCommand not in self.buffer:
+			chunk = self.conn.recv(65536)
+			if not chunk:
+				raise IOError('The Fail2Ban server closed the connection')
+			self.buffer += chunk
+		data, separator, self.buffer = self.buffer.partition(f2bEndCommand)
+		code, value = pickle.loads(data)
+		if code != 0:
+			raise IOError(str(value))
+		return value
+
+	def query(self, *commands):
+		self.conn.sendall(b''.join(pickle.dumps(list(command), 2) + f2bEndCommand for command in commands))
+		return [self.receive() for command in commands]
+
+	def close(self):
+		try:
+			self.conn.sendall(f2bCloseCommand + f2bEndCommand)
+		except socket.error:
+			pass
+		self.conn.close()
+
+def getBannedIPs(client, jails):
+	# Returns the banned IP addresses of every jail, "banned" is available since Fail2Ban 0.11
+	try:
+		return dict((jail, ips) for item in client.query(['banned'])[0] for jail, ips in item.items())
+	except (IOError, AttributeError, ImportError, pickle.UnpicklingError):
+		bans = {}
+		for jail, status in zip(jails, client.query(*[['status', jail] for jail in jails])):
+			actions = dict(dict(status).get('Actions', []))
+			bans[jail] = actions.get('Banned IP list', [])
+		return bans
+
+def getFail2BanState(targets, socketFile = f2bSocketFile, timeout = 5):
+	# Returns the jails which ban every IP address and the networks of the ignoreip options of the jails
+	client = Fail2BanClient(socketFile, timeout)
+	try:
+		status = dict(client.query(['status'])[0])
+		jails = [jail.strip() for jail in str(status.get('Jail list', '')).split(',') if jail.strip()]
+		bans = getBannedIPs(client, jails)
+		ignored = client.query(*[['get', jail, 'ignoreip'] for jail in jails]) if jails else []
+	finally:
+		client.close()
+	banned = NetworkMatcher()
+	for jail in bans:
+		for ip in bans[jail]:
+			try:
+				banned.add(str(ip), jail)
+			except (socket.error, ValueError):
+				pass
+	trusted = compileNetworks([str(network) for networks in ignored for network in networks])
+	return dict((ip, set(banned.match(ip))) for ip in targets), trusted
+
+
+# Define functions to detect Cloudflare
+# The networks of Cloudflare from https://www.cloudflare.com/ips/, they can be updated with --update-cloudflare-ranges
+cloudflareRangesFile = '/var/lib/360-restrictions-check/cloudflare-ranges'
+cloudflareRangesURLs = ['https://www.cloudflare.com/ips-v4', 'https://www.cloudflare.com/ips-v6']
+cloudflareNetworks = [
+	'173.245.48.0/20', '103.21.244.0/22', '103.22.200.0/22', '103.31.4.0/22', '141.101.64.0/18',
+	'108.162.192.0/18', '190.93.240.0/20', '188.114.96.0/20', '197.234.240.0/22', '198.41.128.0/17',
+	'162.158.0.0/15', '104.16.0.0/13', '104.24.0.0/14', '172.64.0.0/13', '131.0.72.0/22',
+	'2400:cb00::/32', '2606:4700::/32', '2803:f800::/32', '2405:b500::/32', '2405:8100::/32',
+	'2a06:98c0::/29', '2c0f:f248::/32',
+]
+
+def loadCloudflareNetworks(rangesFile = cloudflareRangesFile):
+	# The updated networks are used when they were downloaded, the bundled ones otherwise
+	if os.path.isfile(rangesFile):
+		with open(rangesFile) as ranges:
+			networks = [line.strip() for line in ranges if line.strip() and not line.startswith('#')]
+		if networks:
+			return compileNetworks(networks)
+	return compileNetworks(cloudflareNetworks)
+
+def updateCloudflareNetworks(rangesFile = cloudflareRangesFile, timeout = 10):
+	networks = []
+	for url in cloudflareRangesURLs:
+		response = urlopen(url, timeout=timeout)
+		try:
+			networks.extend(response.read().decode().split())
+		finally:
+			response.close()
+	# Nothing is saved if any of the downloaded networks is not valid
+	for network in networks:
+		parseNetwork(network)
+	if not os.path.isdir(os.path.dirname(rangesFile)):
+		os.makedirs(os.path.dirname(rangesFile))
+	with open(rangesFile + '.tmp', 'w') as ranges:
+		ranges.write('\n'.join(networks) + '\n')
+	os.rename(rangesFile + '.tmp', rangesFile)
+	return networks
+
+# Plesk maps the hostname of the server to a local address in /etc/hosts, the system resolver reads it first
+hostsFile = '/etc/hosts'
+publicResolver = '8.8.8.8'
+localNetworks = compileNetworks(['127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '169.254.0.0/16',
+	'::1/128', 'fe80::/10', 'fc00::/7'])
+
+def readHostsAddresses(hostname, hostsFile = hostsFile):
+	# Returns the addresses /etc/hosts maps the hostname to
+	addresses = []
+	if not os.path.isfile(hostsFile):
+		return addresses
+	with io.open(hostsFile, encoding='utf-8', errors='replace') as hosts:
+		for line in hosts:
+			tokens = line.split('#', 1)[0].split()
+			if len(tokens) > 1 and hostname.lower() in [name.lower() for name in tokens[1:]]:
+				addresses.append(tokens[0])
+	return addresses
+
+def parseDigOutput(text):
+	# dig +short prints the CNAME targets along with the addresses, only the addresses are kept
+	addresses = []
+	for line in text.split():
+		try:
+			ipToInt(line)
+		except (socket.error, ValueError):
+			continue
+		if line not in addresses:
+			addresses.append(line)
+	return addresses
+
+def resolveHostname(hostname, timeout):
+	# The system resolver has no timeout of its own, so it runs in a separate thread
+	addresses = []
+	def resolve():
+		try:
+			for family, socktype, proto, canonname, sockaddr in socket.getaddrinfo(hostname, None, 0, socket.SOCK_STREAM):
+				if sockaddr[0] not in addresses:
+					addresses.append(sockaddr[0])
+		except socket.error:
+			pass
+	resolver = threading.Thread(target=resolve)
+	resolver.daemon = True
+	resolver.start()
+	resolver.join(timeout)
+	if resolver.is_alive():
+		raise CommandTimeout("The hostname was not resolved in time: " + hostname)
+	return addresses
 
 
 # Define colored output for print and re-define print based on the Python version
@@ -91,314 +971,722 @@ def prBlue(textToPrint):
 	printFunc("\033[96m {}\033[00m" .format(textToPrint))
 
 
-# Check Cloudflare
-errCCode = False
-getPleskHostname = 'plesk db -Nse "select val from misc where param = \'FullHostName\'"'
-resolveIPList = []
-commandC = 'curl --silent -I {} | grep Server | cut -f 2 -d ":"'
-cArticle = "https://support.plesk.com/hc/en-us/articles/13303705971095"
-
-prBlue("=========================================================")
-prBlue("Checking whether the server is behind Cloudflare:")
-prBlue("=========================================================")
-printFunc()
-
-getServerHostname = subprocess.Popen(getPleskHostname, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-serverHostname = getServerHostname.stdout.readline()
-getIP = 'dig +short @8.8.8.8 ' + serverHostname
-
-resolveIP = subprocess.Popen(getIP, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-
-for ip in resolveIP.stdout:
-	resolveIPList.append(ip.rstrip())
-
-for item in resolveIPList:
-	checkCIP = commandC.format(item)
-	checkCloudflare = subprocess.Popen(checkCIP, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-	if 'cloudflare' in checkCloudflare.stdout.readline():
-		errCCode = True
-		prRed("The server is behind Cloudflare")
-		prRed("Please disable proxying in Cloudflare or use the workaround")
-		break
-	else:
-		prGreen("The server is not behind Cloudflare")
-		break
-
-if errCCode:
+# Define function to run shell commands
+# Every check runs in its own thread, the deadline of the check is kept per thread
+checkContext = threading.local()
+
+def remainingTime(default = None):
+	deadline = getattr(checkContext, 'deadline', None)
+	return default if deadline is None else max(0.1, deadline - time.time())
+
+class CommandTimeout(Exception):
+	pass
+
+# The commands run in sessions of their own, so they are killed with their children. preexec_fn is not
+# safe while the checks run in threads, it is only used by Python 2.7 which has no start_new_session
+newSession = {'start_new_session': True} if sys.version_info[0] >= 3 else {'preexec_fn': os.setsid}
+
+def killProcess(process, killed):
+	killed.append(process.pid)
+	try:
+		os.killpg(process.pid, signal.SIGKILL)
+	except OSError:
+		pass
+
+def runCommand(command, env = None):
+	# The command is killed with all its children when the deadline of the check is reached.
+	# A string is run by the shell, a list is run as is
+	process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=not isinstance(command, list), env=env, **newSession)
+	timeout = remainingTime()
+	timer = None
+	killed = []
+	if timeout is not None:
+		timer = threading.Timer(timeout, killProcess, [process, killed])
+		timer.daemon = True
+		timer.start()
+	try:
+		outData, errData = process.communicate()
+	finally:
+		if timer:
+			timer.cancel()
+	if killed:
+		raise CommandTimeout("The command did not finish in time: " + (" ".join(command) if isinstance(command, list) else command))
+	return outData, errData
+
+
+# Define the client of the psa database
+pleskDbName = 'psa'
+pleskDbUser = 'admin'
+pleskDbPasswordFile = '/etc/psa/.psa.shadow'
+pleskDbSockets = ['/var/run/mysqld/mysqld.sock', '/var/lib/mysql/mysql.sock']
+
+class DBError(Exception):
+	pass
+
+class PleskDB(object):
+	# One connection to the psa database for the whole run, shared by the checks. The queries take their
+	# parameters as %s. Without a MySQL driver (pymysql or MySQLdb) the queries go through the mysql client
+	# with the parameters quoted. A "sqlite:///path/to/file" DSN points the queries to a SQLite stand-in
+	def __init__(self, dsn = None):
+		self.dsn = dsn
+		self.conn = None
+		self.connected = False
+		self.placeholder = '%s'
+		self.errors = ()
+		self.lock = threading.Lock()
+
+	def connect(self):
+		self.connected = True
+		if self.dsn and self.dsn.startswith('sqlite://'):
+			import sqlite3
+			self.conn = sqlite3.connect(self.dsn[len('sqlite://'):], check_same_thread=False)
+			self.placeholder = '?'
+			self.errors = (sqlite3.Error,)
+			return
+		try:
+			import pymysql as driver
+			credentials = {'user': pleskDbUser, 'database': pleskDbName}
+			passwordKey = 'password'
+		except ImportError:
+			try:
+				import MySQLdb as driver
+				credentials = {'user': pleskDbUser, 'db': pleskDbName}
+				passwordKey = 'passwd'
+			except ImportError:
+				return
+		try:
+			with open(pleskDbPasswordFile) as passwordFile:
+				credentials[passwordKey] = passwordFile.read().strip()
+			sockets = [sock for sock in pleskDbSockets if os.path.exists(sock)]
+			if sockets:
+				credentials['unix_socket'] = sockets[0]
+			else:
+				credentials['host'] = 'localhost'
+			self.conn = driver.connect(connect_timeout=10, charset='utf8', **credentials)
+			self.errors = (driver.Error,)
+		except (IOError, OSError, driver.Error):
+			# The mysql client is used when the database cannot be reached directly
+			self.conn = None
+
+	def inline(self, query, params):
+		quoted = ["'" + str(param).replace('\\', '\\\\').replace("'", "\\'") + "'" for param in params]
+		parts = query.split('%s')
+		return parts[0] + ''.join(value + part for value, part in zip(quoted, parts[1:]))
+
+	def queryClient(self, query):
+		# "plesk db" is used when the password of the database cannot be read
+		try:
+			with open(pleskDbPasswordFile) as passwordFile:
+				env = dict(os.environ, MYSQL_PWD=passwordFile.read().strip())
+			command = ['mysql', '-u' + pleskDbUser, '-D' + pleskDbName, '-Nse', query]
+		except IOError:
+			env = None
+			command = ['plesk', 'db', '-Nse', query]
+		try:
+			outData, errData = runCommand(command, env)
+		except OSError as e:
+			raise DBError(str(e))
+		if errData.strip():
+			raise DBError(errData.strip())
+		return [tuple('' if value == 'NULL' else value for value in row.split('\t')) for row in outData.splitlines()]
+
+	def query(self, query, params = ()):
+		# Returns the rows as tuples of strings, NULL is returned as an empty string
+		with self.lock:
+			if not self.connected:
+				self.connect()
+			if self.conn is None:
+				return self.queryClient(self.inline(query, params))
+			cursor = self.conn.cursor()
+			try:
+				cursor.execute(query.replace('%s', self.placeholder), tuple(params))
+				return [tuple('' if value is None else str(value) for value in row) for row in cursor.fetchall()]
+			except self.errors as e:
+				raise DBError(str(e))
+			finally:
+				cursor.close()
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+pleskDB = PleskDB()
+
+
+# Define the report of a check, it is shown when the check is finished
+ansiPattern = re.compile(r'\033\[\d+m')
+
+class CheckReport(object):
+	def __init__(self, name, title = '', article = ''):
+		self.name = name
+		self.title = title
+		self.article = article
+		self.status = 'ok'
+		self.restricted = False
+		self.messages = []
+		self.details = {}
+		self.duration = None
+		self.closed = False
+		self.fingerprint = None
+		self.cached = False
+
+	def add(self, output, text):
+		# The messages of a timed out check are not changed anymore
+		if not self.closed:
+			self.messages.append((output, text))
+
+	def red(self, text):
+		self.add(prRed, text)
+
+	def green(self, text):
+		self.add(prGreen, text)
+
+	def blue(self, text):
+		self.add(prBlue, text)
+
+	def plain(self, text):
+		self.add(printFunc, text)
+
+	def error(self, text):
+		self.status = 'error'
+		self.plain("ERROR: " + text.strip())
+
+	def timeOut(self, timeout):
+		if self.closed:
+			return
+		self.status = 'timeout'
+		self.red("The check did not finish in {} seconds".format(timeout))
+		self.red("Please check it on your own")
+		self.closed = True
+
+	def show(self):
+		prBlue("=" * (len(self.title) + 8))
+		prBlue(self.title)
+		prBlue("=" * (len(self.title) + 8))
+		printFunc()
+		for output, text in self.messages:
+			output(text)
+		if self.restricted:
+			printFunc()
+			prRed(">>> Here is the article for help: " + self.article)
 		printFunc()
-		prRed(">>> Here is the article for help: " + cArticle)
 
-printFunc()
+	def dump(self):
+		return {
+			'status': self.status,
+			'restricted': self.restricted,
+			'messages': [[output.__name__, text] for output, text in self.messages],
+			'details': self.details,
+		}
+
+	def restore(self, data):
+		outputs = dict((output.__name__, output) for output in (prRed, prGreen, prBlue, printFunc))
+		self.status = data['status']
+		self.restricted = data['restricted']
+		self.messages = [(outputs[name], text) for name, text in data['messages']]
+		self.details = data['details']
+		self.cached = True
+
+	def toDict(self):
+		return {
+			'status': self.status,
+			'restricted': self.restricted,
+			'cached': self.cached,
+			'messages': [ansiPattern.sub('', text).strip() for output, text in self.messages],
+			'details': self.details,
+			'duration': self.duration,
+			'article': self.article,
+		}
+
+
+# Define the cache of the results of the checks
+defaultCacheFile = '/var/lib/360-restrictions-check/cache.json'
+cacheVersion = 1
+
+def fileSignature(path):
+	# Returns the inode, the size and the modification time of the file, or None when there is no such file
+	try:
+		fileStat = os.stat(path)
+	except OSError:
+		return None
+	return [fileStat.st_ino, fileStat.st_size, fileStat.st_mtime]
+
+class ResultCache(object):
+	# Keeps the results of the checks with the fingerprints of their inputs, a check whose inputs
+	# did not change since the previous run takes its result from the cache
+	def __init__(self, path = None):
+		self.path = path
+		self.data = None
+		self.lock = threading.Lock()
+
+	def load(self):
+		if self.data is None:
+			self.data = {}
+			try:
+				with open(self.path) as cacheFile:
+					data = json.load(cacheFile)
+				if data.get('version') == cacheVersion and data.get('ipAddresses') == ipAddresses:
+					self.data = data
+			except (IOError, ValueError):
+				pass
+		return self.data
+
+	def get(self, key, default = None):
+		if not self.path:
+			return default
+		with self.lock:
+			return self.load().get(key, default)
+
+	def set(self, key, value):
+		if not self.path:
+			return
+		with self.lock:
+			self.load()[key] = value
+
+	def lookup(self, report, inputs):
+		# Returns True when the report is restored from the cache
+		if not self.path:
+			return False
+		report.fingerprint = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+		entry = self.get('checks', {}).get(report.name)
+		if entry and entry.get('fingerprint') == report.fingerprint:
+			report.restore(entry['report'])
+			return True
+		return False
 
+	def save(self, reports):
+		if not self.path:
+			return
+		with self.lock:
+			data = self.load()
+			data['version'] = cacheVersion
+			data['ipAddresses'] = ipAddresses
+			cachedChecks = data.setdefault('checks', {})
+			for report in reports:
+				if report.fingerprint and report.status == 'ok' and not report.cached:
+					cachedChecks[report.name] = {'fingerprint': report.fingerprint, 'report': report.dump()}
+			try:
+				if not os.path.isdir(os.path.dirname(self.path)):
+					os.makedirs(os.path.dirname(self.path))
+				with open(self.path + '.tmp', 'w') as cacheFile:
+					json.dump(data, cacheFile)
+				os.rename(self.path + '.tmp', self.path)
+			except (IOError, OSError):
+				pass
+
+resultCache = ResultCache()
 
-# Check firewall rules
-listRules = []
-checkDropRule = False
-checkAllowRule = False
-positionAllowDrop = True
-errFCode = False
-fArticle = "https://support.plesk.com/hc/en-us/articles/12377519983511"
-
-prBlue("================================")
-prBlue("Checking firewall rules:")
-prBlue("================================")
-printFunc()
-
-commandF = 'iptables -nvL | grep :8443 | awk \'{print $3, $8}\''
-firewallOutput = subprocess.Popen(commandF, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-outData, errData = firewallOutput.communicate()
-
-if errData and not "iptables-legacy" in errData:
-	printFunc("ERROR: " + errData)
-	prRed("Please fix the issue and re-run this script")
-	prRed("Otherwise, please check the firewall rules on your own")
-	printFunc()
-elif not outData:
-	prGreen("There are no active firewall restrictions for accessing Plesk UI via port 8443")
-	printFunc()
-else:
-	for line in outData.splitlines():
-		lineToList = line.split()
-		listRules.append(lineToList)
-
-	for sublist in listRules:
-		if checkIfInList(listRules, 'DROP', '0.0.0.0/0') or checkIfInList(listRules, 'REJECT', '0.0.0.0/0'):
-			errFCode = True
-			checkDropRule = True
-			dropRulePosition = getPosition(listRules, 'DROP', '0.0.0.0/0')
-			break
 
-	for sublist in listRules:
-		if checkIfInList(listRules, 'ACCEPT', '0.0.0.0/0'):
-			checkAllowRule = True
-			allowRulePosition = getPosition(listRules, 'ACCEPT', '0.0.0.0/0')
-			break
+# Check Cloudflare
+def evaluateCloudflare(report, hostname, resolvedIPs, networks = None, probe = None, localMapping = False):
+	# The networks are the compiled networks of Cloudflare, the probe tells whether the server answered
+	# every address with the Server header of Cloudflare. The local mapping tells that the addresses
+	# come from /etc/hosts or are local because the public DNS could not be asked
+	report.details['hostname'] = hostname
+	report.details['resolvedIPs'] = resolvedIPs
+	report.details['localMapping'] = localMapping
+
+	if not resolvedIPs:
+		report.red("Cannot resolve the hostname of the server" + "\033[93m {}\033[00m".format(hostname))
+		return
+
+	if networks is None:
+		networks = compileNetworks(cloudflareNetworks)
+	cloudflareIPs = [ip for ip in resolvedIPs if networks.match(ip)]
+	report.details['cloudflareIPs'] = cloudflareIPs
+	report.restricted = bool(cloudflareIPs)
+	if probe is not None:
+		# The Server header of the responses only confirms the result of the networks
+		report.details['probe'] = probe
+		report.restricted = report.restricted or any(probe.values())
+
+	if report.restricted:
+		report.red("The server is behind Cloudflare")
+		report.red("Please disable proxying in Cloudflare or use the workaround")
+	elif localMapping:
+		report.blue("The hostname" + "\033[93m {}\033[00m".format(hostname) + " resolves to " + ", ".join(resolvedIPs) + " from /etc/hosts or a local address, the public DNS could not be asked")
+		report.blue("The result is inconclusive, please check the DNS records of the hostname on your own")
+	else:
+		report.green("The server is not behind Cloudflare")
+	report.details['behindCloudflare'] = report.restricted
+
+def checkCloudflare(report, probe = False):
+	commandC = 'curl --silent --max-time 10 -I {} | grep Server | cut -f 2 -d ":"'
+	commandDig = 'dig +short +time=5 +tries=1 @{0} {1} A {1} AAAA'
+
+	try:
+		serverHostname = ''.join(row[0] for row in pleskDB.query("SELECT val FROM misc WHERE param = %s", ('FullHostName',))).strip()
+	except DBError as e:
+		report.error(str(e))
+		report.red("Please fix the issue and re-run this script")
+		return
+	resolveIPList = resolveHostname(serverHostname, remainingTime(10)) if serverHostname else []
+	# A local mapping says nothing about the DNS records, the public resolver is asked instead
+	localMapping = bool(resolveIPList) and (bool(readHostsAddresses(serverHostname)) or any(localNetworks.match(ip) for ip in resolveIPList))
+	if localMapping:
+		dnsIPList = parseDigOutput(runCommand(commandDig.format(publicResolver, serverHostname))[0])
+		if dnsIPList:
+			resolveIPList, localMapping = dnsIPList, False
+	probeResults = dict((ip, 'cloudflare' in runCommand(commandC.format(ip))[0].lower()) for ip in resolveIPList) if probe else None
+	evaluateCloudflare(report, serverHostname, resolveIPList, loadCloudflareNetworks(), probeResults, localMapping)
 
-	if checkAllowRule and checkDropRule:
-		for ip in ipAddresses:
-			for sublist in listRules:
-				if checkIpInSubnet(ipConvert(ip), startIP(sublist[1]), endIP(sublist[1])):
-					if comparePositions(dropRulePosition, getPosition(listRules, sublist[0], sublist[1])) and comparePositions(dropRulePosition, allowRulePosition):
-						prRed("Access is not allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-					elif "DROP" in sublist or "REJECT" in sublist:
-						prRed("Access is forbidden for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-					elif (("DROP" in sublist or "REJECT" in sublist) and comparePositions(allowRulePosition, getPosition(listRules, sublist[0], sublist[1]))) or ("ACCEPT" in sublist and comparePositions(getPosition(listRules, sublist[0], sublist[1]), dropRulePosition)):
-						prGreen("Access is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-	elif checkAllowRule and allowRulePosition[0] == '0':
-		prGreen("There are no active firewall restrictions for accessing Plesk UI via port 8443")
-	elif checkAllowRule:
-		for ip in ipAddresses:
-			for sublist in listRules:
-				if checkIpInSubnet(ipConvert(ip), startIP(sublist[1]), endIP(sublist[1])):
-					if ("DROP" in sublist or "REJECT" in sublist) and comparePositions(getPosition(listRules, sublist[0], sublist[1]), allowRulePosition):
-						errFCode = True
-						prRed("Access is forbidden for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-					else:
-						prGreen("Access is not filtered for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-	elif checkDropRule:
-		for ip in ipAddresses:
-			for sublist in listRules:
-				if checkIpInSubnet(ipConvert(ip), startIP(sublist[1]), endIP(sublist[1])):
-					if "ACCEPT" in sublist and comparePositions(getPosition(listRules, sublist[0], sublist[1]), dropRulePosition):
-						prGreen("Access is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-					else:
-						prRed("Access is not allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-	elif not checkAllowRule and not checkDropRule:
-		for ip in ipAddresses:
-			for sublist in listRules:
-				if checkIpInSubnet(ipConvert(ip), startIP(sublist[1]), endIP(sublist[1])):
-					if "DROP" in sublist or "REJECT" in sublist:
-						errFCode = True
-						prRed("Access is forbidden for the IP address" + "\033[93m {}\033[00m".format(ip))
-						break
-					else:
-						prGreen("There are no firewall restrictions for accessing Plesk UI via port 8443")
-
-	if errFCode:
-		printFunc()
-		prRed(">>> Here is the article for help: " + fArticle)
 
-	printFunc()
+# Check firewall rules
+def parseIpAddr(text):
+	# Returns the global addresses from the output of "ip -o addr show"
+	addresses = []
+	for line in text.splitlines():
+		tokens = line.split()
+		scope = tokens[tokens.index('scope') + 1] if 'scope' in tokens[:-1] else 'global'
+		for position, token in enumerate(tokens[:-1]):
+			if token in ('inet', 'inet6') and scope not in ('host', 'link'):
+				addresses.append(tokens[position + 1].split('/')[0])
+	return addresses
+
+def evaluateFirewall(report, targets, iptablesData = '', ipsetData = '', ip6tablesData = '', nftData = '', errData = '', localAddresses = None):
+	# The data are the outputs of iptables-save, ipset save, ip6tables-save and nft -j list ruleset,
+	# the local addresses are matched by the destination matches of the rules. The input hooks of
+	# both rulesets are evaluated together, as the kernel runs all of them: Docker adds iptables
+	# rules while firewalld drops in its own nftables table
+	firewall = None
+	sources = []
+	try:
+		if iptablesData:
+			ipsets = parseIpsetSave(ipsetData)
+			firewall = parseIptablesSave(iptablesData, ipsets, Firewall(localAddresses))
+			sources.append('iptables')
+			if ip6tablesData:
+				parseIptablesSave(ip6tablesData, ipsets, firewall, 128)
+		if nftData.strip():
+			# The tables of iptables-nft are shown by nft as well, the ones of iptables-legacy are not.
+			# iptables-nft-save tells so in its header, iptables-legacy prints "iptables-save"
+			nftBackend = iptablesData.startswith('# Generated by iptables-nft-save')
+			firewall = parseNftRuleset(nftData, firewall or Firewall(localAddresses), iptablesNftTables if nftBackend else ())
+			sources.append('nftables')
+	except ValueError as e:
+		firewall = None
+		errData = str(e)
+	if sources:
+		report.details['source'] = ' and '.join(sources)
+
+	if firewall is None and errData and not "iptables-legacy" in errData:
+		report.error(errData)
+		report.red("Please fix the issue and re-run this script")
+		report.red("Otherwise, please check the firewall rules on your own")
+		return
+
+	verdicts = firewall.evaluateMany(targets) if firewall else {}
+	report.details['verdicts'] = dict((ip, {'verdict': verdicts[ip][0], 'rule': verdicts[ip][1] and verdicts[ip][1]['text']}) for ip in verdicts)
+	for ip in verdicts:
+		if verdicts[ip][0] == 'UNDETERMINED':
+			report.details['verdicts'][ip]['unknown'] = verdicts[ip][1]['unknown'] or ['destination']
+	if not [ip for ip in verdicts if verdicts[ip] != ('ACCEPT', None)]:
+		report.green("There are no active firewall restrictions for accessing Plesk UI via port 8443")
+		return
+	for ip in targets:
+		verdict, rule = verdicts[ip]
+		if verdict == 'ACCEPT':
+			report.green("Access is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
+		elif verdict == 'UNDETERMINED':
+			report.blue("Access for the IP address" + "\033[93m {}\033[00m".format(ip) + " cannot be determined because of " + rule['text'])
+		else:
+			report.restricted = True
+			report.red("Access is forbidden for the IP address" + "\033[93m {}\033[00m".format(ip) + " by " + (rule['text'] if rule else "the default policy"))
+	if [ip for ip in verdicts if verdicts[ip][0] == 'UNDETERMINED']:
+		report.blue("The rules above depend on the destination address, rate limits or other state of the connection, please check them on your own")
+
+def checkFirewall(report):
+	commandF = 'iptables-save -t filter'
+	commandF6 = 'ip6tables-save -t filter'
+	commandIpset = 'ipset save'
+	commandNft = 'nft -j list ruleset'
+	commandAddr = 'ip -o addr show'
+	outData, errData = runCommand(commandF)
+	ipsetData = runCommand(commandIpset)[0] if '--match-set' in outData else ''
+	ip6Data = runCommand(commandF6)[0] if '-A ' in outData and [ip for ip in ipAddresses if ':' in ip] else ''
+	# The rules of firewalld and other nftables based firewalls are not shown by iptables-save, they
+	# are read even when iptables has rules of its own, like the ones of Docker
+	nftData = runCommand(commandNft)[0]
+	# The destination matches are evaluated against the addresses of the server
+	addrData = runCommand(commandAddr)[0] if re.search(r' -d | --dst-range |--match-set \S+ dst|"daddr"', outData + ip6Data + nftData) else ''
+
+	if not errData and resultCache.lookup(report, [outData, ipsetData, ip6Data, nftData, addrData]):
+		return
+	evaluateFirewall(report, ipAddresses, outData, ipsetData, ip6Data, nftData, errData, parseIpAddr(addrData) if addrData else None)
 
 
 # Check Fail2Ban
-errF2BCode = False
-f2bArticle = "https://support.plesk.com/hc/en-us/articles/12377009252247"
-
-prBlue("=========================================")
-prBlue("Checking Fail2Ban logs:")
-prBlue("=========================================")
-printFunc()
-
-commandCheckF2BLogs = 'cat /var/log/fail2ban.log'
-commandCheckF2BTrusted = 'grep "ignoreip" /etc/fail2ban/jail.local'
-f2bEntries = []
-
-checkF2BLogs = subprocess.Popen(commandCheckF2BLogs, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-outLogsData, errLogsData = checkF2BLogs.communicate()
-checkF2BTrusted = subprocess.Popen(commandCheckF2BTrusted, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-outTrustedData, errTrustedData = checkF2BTrusted.communicate()
-
-if errLogsData and not "No such file or directory" in errLogsData:
-	printFunc("ERROR: " + errData)
-	prRed("Please fix the issue and re-run this script")
-	prRed("Otherwise, please check the Fail2Ban logs on your own")
-	printFunc()
-elif "No such file or directory" in errLogsData:
-    prRed("The file /var/log/fail2ban.log does not exist")
-    prRed("Fail2Ban may be disabled but it is recommended to double-check that manually")
-else:
-    for line in outLogsData.splitlines():
-        f2bEntries.append(line)
-
-    if [item for entry in ipAddresses for item in f2bEntries if entry in item]:
-        for ip in ipAddresses:
-            if ip in outTrustedData:
-                prGreen("The trusted list of Fail2Ban contains the IP address" + "\033[93m {}\033[00m".format(ip))
-            elif any(ip in i for i in f2bEntries):
-                errF2BCode = True
-                prRed("The Fail2Ban log has records about the IP address" + "\033[93m {}\033[00m".format(ip))
-    else:
-        prGreen("Fail2Ban did not ban any of the IP addresses")
-
-if errF2BCode:
-    printFunc()
-    prRed(">>> Here is the article for help: " + f2bArticle)
-
-printFunc()
+def evaluateFail2Ban(report, targets, records, bans, trusted):
+	# The records are the numbers of the log records about every IP address, the bans are the jails
+	# which ban it and the trusted networks are the compiled ignoreip options of the jails
+	if records is None:
+		report.red("The file /var/log/fail2ban.log does not exist")
+		report.red("Fail2Ban may be disabled but it is recommended to double-check that manually")
+		return
+
+	report.details['bans'] = dict((ip, sorted(bans[ip])) for ip in targets)
+	report.details['records'] = records
+	report.details['trusted'] = [ip for ip in targets if trusted.match(ip)]
+	if [ip for ip in targets if records[ip]]:
+		for ip in targets:
+			if trusted.match(ip):
+				report.green("The trusted list of Fail2Ban contains the IP address" + "\033[93m {}\033[00m".format(ip))
+			elif bans[ip]:
+				report.restricted = True
+				report.red("Fail2Ban bans the IP address" + "\033[93m {}\033[00m".format(ip) + " in the jails: " + ", ".join(sorted(bans[ip])))
+			elif records[ip]:
+				report.green("The Fail2Ban log has records about the IP address" + "\033[93m {}\033[00m".format(ip) + " but it is not banned")
+	else:
+		report.green("Fail2Ban did not ban any of the IP addresses")
+
+def evaluateFail2BanLogs(report, targets, logLines, jailLines = ()):
+	# The lines of the logs go from the oldest one, the jail lines are the lines of jail.local
+	records, bans = scanFail2BanLog(logLines, targets)
+	report.details['source'] = 'logs'
+	evaluateFail2Ban(report, targets, records, bans, parseIgnoredNetworks(jailLines))
+
+def checkFail2Ban(report):
+	f2bRecords = f2bBans = f2bTrusted = None
+
+	try:
+		# The live state of the Fail2Ban server is used when it is running, the logs are scanned otherwise
+		if os.path.exists(f2bSocketFile):
+			try:
+				f2bBans, f2bTrusted = getFail2BanState(ipAddresses, timeout=remainingTime(5))
+				f2bRecords = dict((ip, len(f2bBans[ip])) for ip in ipAddresses)
+				report.details['source'] = 'socket'
+			except (socket.error, IOError, ValueError, EOFError, pickle.UnpicklingError) as e:
+				report.blue("Cannot query the Fail2Ban server, checking the Fail2Ban logs instead: " + str(e))
+		f2bLogs = findFail2BanLogs() if f2bRecords is None else []
+		if f2bLogs:
+			if resultCache.lookup(report, [[path, fileSignature(path)] for path in f2bLogs] + [fileSignature(f2bJailFile)]):
+				return
+			f2bRecords, f2bBans = scanFail2BanLogs(f2bLogs, ipAddresses, resultCache)
+			f2bTrusted = readIgnoredNetworks()
+			report.details['source'] = 'logs'
+	except (IOError, OSError) as e:
+		report.error(str(e))
+		report.red("Please fix the issue and re-run this script")
+		report.red("Otherwise, please check the Fail2Ban logs on your own")
+		return
+
+	evaluateFail2Ban(report, ipAddresses, f2bRecords, f2bBans, f2bTrusted)
 
 
 # Check administrative restrictions
-noAdmRes = False
-denyList = []
-excludeDenyList = ['52.51.23.204', '52.213.169.7', '34.254.37.129']
-allowList = []
-excludeAllowList = []
-ipCount = 0
-errACode = False
-aArticle = "https://support.plesk.com/hc/en-us/articles/12377478650647"
-
-prBlue("===============================================================")
-prBlue("Checking restrictions for administrative access rules:")
-prBlue("===============================================================")
-printFunc()
-
-commandAR = 'MYSQL_PWD=$(cat /etc/psa/.psa.shadow) mysql -uadmin -Nse "SELECT type,netaddr,netmask FROM psa.cp_access"'
-optionAR = 'MYSQL_PWD=$(cat /etc/psa/.psa.shadow) mysql -uadmin -Nse "SELECT val FROM psa.misc WHERE param = \'access_policy\'"'
-restrictions = subprocess.Popen(commandAR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-outData, errData = restrictions.communicate()
-optionCheck = subprocess.Popen(optionAR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-policy = optionCheck.stdout.readline()
-
-if errData:
-	printFunc("ERROR:" + errData)
-	prRed("Please fix the issue and re-run this script")
-	prRed("Otherwise, please check the administrative restirction on your own")
-	prRed("Here is the article for help: " + aArticle)
-	printFunc()
-else:
-	if policy.strip() == "allow":
-		for line in outData.splitlines():
-			if "allow" in line:
-				allowList.append(line.split())
-
-	if policy.strip() == "deny":
-		for line in outData.splitlines():
-			if "deny" in line:
-				denyList.append(line.split())
-
-	if not allowList and not denyList:
-		noAdmRes = True
-		prGreen("There are no administrative restrictions")
-
-	if allowList and not noAdmRes:
-		for ip in ipAddresses:
-			for item in allowList:
-				if checkIpInSubnet(ipConvert(ip), startIP(str(item[1]) + '/' + str(calculateCIDR(item[2]))), endIP(str(item[1]) + '/' + str(calculateCIDR(item[2])))):
-					errACode = True
-					prRed("Access to the Plesk UI is denied for the IP address" + "\033[93m {}\033[00m".format(ip))
-					excludeAllowList.append(ip)
-					break
-
-	if excludeAllowList and not noAdmRes:
-		for ip in ipAddresses:
-			if ip not in excludeAllowList:
-				prGreen("Access to the Plesk UI is not denied for the IP address" + "\033[93m {}\033[00m".format(ip))
-
-	if denyList and not noAdmRes:
-		for ip in ipAddresses:
-			for item in denyList:
-				if checkIpInSubnet(ipConvert(ip), startIP(str(item[1]) + '/' + str(calculateCIDR(item[2]))), endIP(str(item[1]) + '/' + str(calculateCIDR(item[2])))):
-					prGreen("Access to the Plesk UI is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
-					excludeDenyList.remove(ip)
-					break
+def evaluateAdminAccess(report, targets, rules, policy):
+	# The rules are the rows of cp_access (type, netaddr, netmask), the policy is misc.access_policy
+	denyList = []
+	allowList = []
+	deniedIPs = []
 
-	if excludeDenyList and not noAdmRes:
-		for ip in ipAddresses:
-			if ip in excludeDenyList:
-				errACode = True
-				prRed("Access to the Plesk UI is not allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
+	report.details['policy'] = policy
+	if policy == "allow":
+		allowList = [row for row in rules if row[0] == "allow"]
 
-	if errACode:
-		printFunc()
-		prRed(">>> Here is the article for help: " + aArticle)
+	if policy == "deny":
+		denyList = [row for row in rules if row[0] == "deny"]
 
-	printFunc()
+	if not allowList and not denyList:
+		report.green("There are no administrative restrictions")
+		return
+
+	if allowList:
+		allowMatcher = compileNetworks([item[1] for item in allowList], [item[2] for item in allowList])
+		for ip in targets:
+			if allowMatcher.match(ip):
+				report.red("Access to the Plesk UI is denied for the IP address" + "\033[93m {}\033[00m".format(ip))
+				deniedIPs.append(ip)
+
+		if deniedIPs:
+			for ip in targets:
+				if ip not in deniedIPs:
+					report.green("Access to the Plesk UI is not denied for the IP address" + "\033[93m {}\033[00m".format(ip))
+
+	if denyList:
+		denyMatcher = compileNetworks([item[1] for item in denyList], [item[2] for item in denyList])
+		for ip in targets:
+			if denyMatcher.match(ip):
+				report.green("Access to the Plesk UI is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
+			else:
+				deniedIPs.append(ip)
+
+		for ip in deniedIPs:
+			report.red("Access to the Plesk UI is not allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
+
+	report.restricted = bool(deniedIPs)
+	report.details['denied'] = deniedIPs
+
+def checkAdminAccess(report):
+	try:
+		rules = pleskDB.query("SELECT type, netaddr, netmask FROM cp_access")
+		policy = ''.join(row[0] for row in pleskDB.query("SELECT val FROM misc WHERE param = %s", ('access_policy',))).strip()
+	except DBError as e:
+		report.error(str(e))
+		report.red("Please fix the issue and re-run this script")
+		report.red("Otherwise, please check the administrative restirction on your own")
+		report.red("Here is the article for help: " + report.article)
+		return
+
+	evaluateAdminAccess(report, ipAddresses, rules, policy)
 
 
 # Check API
-errApiCode = False
-apiArticle = "https://support.plesk.com/hc/en-us/articles/12377275665559"
-
-prBlue("=========================================")
-prBlue("Checking [api] section in panel.ini:")
-prBlue("=========================================")
-printFunc()
-
-commandCheckAPI = 'grep "^\[api\]" /usr/local/psa/admin/conf/panel.ini'
-commandAPI = 'sed -n "/^\[api\]/,/^\[/p" /usr/local/psa/admin/conf/panel.ini'
-checkAPI = subprocess.Popen(commandCheckAPI, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-apiSection = subprocess.Popen(commandAPI, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
-
-if checkAPI.stdout.readline():
-	for line in apiSection.stdout:
+def getApiSection(panelIni):
+	# Returns the lines of the [api] sections of panel.ini with the headers of the sections
+	# and the header of the section which follows
+	lines = []
+	inSection = False
+	for line in panelIni.splitlines():
+		if inSection:
+			lines.append(line)
+			inSection = not line.startswith('[')
+		elif line.startswith('[api]'):
+			lines.append(line)
+			inSection = True
+	return lines
+
+def evaluateApi(report, targets, panelIni):
+	# The panel.ini is the content of /usr/local/psa/admin/conf/panel.ini
+	deniedIPs = []
+	apiSection = getApiSection(panelIni)
+
+	if not apiSection:
+		report.green("There are no restrictions for accessing the API")
+		return
+
+	for line in apiSection:
 		if "enabled" in line and "off" in line and ";" not in line:
-			errApiCode = True
-			prRed("Access to the API is restricted for all connections")
+			report.restricted = True
+			report.details['enabled'] = False
+			report.red("Access to the API is restricted for all connections")
 		elif "allowedIPs" in line and not ";" in line:
-			for ip in ipAddresses:
-				if ip not in line:
-					errApiCode = True
-					prRed("Access to the API is not allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
+			apiMatcher = compileNetworks(line.split('=', 1)[-1].replace('"', '').replace(',', ' ').split())
+			for ip in targets:
+				if not apiMatcher.match(ip):
+					report.restricted = True
+					deniedIPs.append(ip)
+					report.red("Access to the API is not allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
 				else:
-					prGreen("Access to the API is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
+					report.green("Access to the API is allowed for the IP address" + "\033[93m {}\033[00m".format(ip))
 		elif "allowedIPs" in line and ";" in line:
-			prGreen("There are no restrictions for accessing the API")
-else:
-	prGreen("There are no restrictions for accessing the API")
-
-if errApiCode:
-	printFunc()
-	prRed(">>> Here is the article for help: " + apiArticle)
-
-printFunc()
-
-
-# Additional section with IP addresses
-if errFCode or errACode or errApiCode:
+			report.green("There are no restrictions for accessing the API")
+	report.details['denied'] = deniedIPs
+
+def checkApi(report):
+	if resultCache.lookup(report, [fileSignature(panelIniFile)]):
+		return
+
+	panelIni = ''
+	if os.path.isfile(panelIniFile):
+		with io.open(panelIniFile, encoding='utf-8', errors='replace') as panelIniContent:
+			panelIni = panelIniContent.read()
+	evaluateApi(report, ipAddresses, panelIni)
+
+
+# Define the checks with their titles and the articles for help
+checks = [
+	('cloudflare', "Checking whether the server is behind Cloudflare:", "https://support.plesk.com/hc/en-us/articles/13303705971095", checkCloudflare),
+	('firewall', "Checking firewall rules:", "https://support.plesk.com/hc/en-us/articles/12377519983511", checkFirewall),
+	('fail2ban', "Checking Fail2Ban:", "https://support.plesk.com/hc/en-us/articles/12377009252247", checkFail2Ban),
+	('admin_access', "Checking restrictions for administrative access rules:", "https://support.plesk.com/hc/en-us/articles/12377478650647", checkAdminAccess),
+	('api', "Checking [api] section in panel.ini:", "https://support.plesk.com/hc/en-us/articles/12377275665559", checkApi),
+]
+
+# The restrictions of these checks are resolved by adding the IP addresses
+ipRestrictionChecks = ('firewall', 'admin_access', 'api')
+
+
+# Define the check runner
+def runCheck(function, report, timeout):
+	checkContext.deadline = time.time() + timeout
+	started = time.time()
+	try:
+		function(report)
+	except CommandTimeout:
+		report.timeOut(timeout)
+	except Exception as e:
+		report.status = 'failed'
+		report.plain("ERROR: {}: {}".format(type(e).__name__, e))
+	report.duration = round(time.time() - started, 3)
+
+def runChecks(checks, timeout, showReport = True):
+	# Every check runs in its own thread with its own deadline, so the whole run takes as long as
+	# the slowest check. The reports are shown in the order of the checks as soon as they are ready
+	reports = []
+	threads = []
+	for name, title, article, function in checks:
+		report = CheckReport(name, title, article)
+		thread = threading.Thread(target=runCheck, args=(function, report, timeout))
+		thread.daemon = True
+		thread.start()
+		reports.append(report)
+		threads.append(thread)
+
+	deadline = time.time() + timeout
+	for thread, report in zip(threads, reports):
+		thread.join(max(0, deadline - time.time()))
+		if thread.is_alive():
+			report.timeOut(timeout)
+		if showReport:
+			report.show()
+	return reports
+
+def showIpAddresses():
 	printFunc()
 	prBlue("++++++++++++++++++++++++++++++++++++++++++++++++")
 	prBlue("++++++++++++++++++++++++++++++++++++++++++++++++")
 	prBlue("The following IP addresses should be added:")
-	prBlue("\t" + ipAddresses[0])
-	prBlue("\t" + ipAddresses[1])
-	prBlue("\t" + ipAddresses[2])
+	for ip in ipAddresses:
+		prBlue("\t" + ip)
 	prBlue("++++++++++++++++++++++++++++++++++++++++++++++++")
 	prBlue("++++++++++++++++++++++++++++++++++++++++++++++++")
+
+def main():
+	parser = argparse.ArgumentParser(description='Check whether there are any restrictions to add the server to Plesk 360')
+	parser.add_argument('--json', default=None, help='write the results in JSON to the file (- for stdout instead of the text)')
+	parser.add_argument('--timeout', type=float, default=defaultTimeout, help='how long every check may take, in seconds')
+	parser.add_argument('--cloudflare-probe', action='store_true', help='confirm the Cloudflare check with an HTTP request to the server')
+	parser.add_argument('--update-cloudflare-ranges', action='store_true', help='download the current networks of Cloudflare and exit')
+	parser.add_argument('--db-dsn', default=None, help='the database to query instead of the psa database, e.g. sqlite:///tmp/psa.sqlite')
+	parser.add_argument('--cache-file', default=defaultCacheFile, help='the file to keep the results of the checks in')
+	parser.add_argument('--no-cache', action='store_true', help='run all the checks without the cached results')
+	options = parser.parse_args()
+	pleskDB.dsn = options.db_dsn
+	resultCache.path = None if options.no_cache else options.cache_file
+
+	if options.update_cloudflare_ranges:
+		try:
+			networks = updateCloudflareNetworks()
+		except (IOError, OSError, ValueError, socket.error) as e:
+			prRed("Cannot update the networks of Cloudflare: {}".format(e))
+			sys.exit(1)
+		prGreen("{} networks of Cloudflare are saved to {}".format(len(networks), cloudflareRangesFile))
+		return
+
+	checkOptions = {'cloudflare': {'probe': options.cloudflare_probe}}
+	checkList = [(name, title, article, functools.partial(function, **checkOptions.get(name, {}))) for name, title, article, function in checks]
+	reports = runChecks(checkList, options.timeout, options.json != '-')
+	pleskDB.close()
+	resultCache.save(reports)
+
+	restricted = [report.name for report in reports if report.restricted and report.name in ipRestrictionChecks]
+	if restricted and options.json != '-':
+		showIpAddresses()
+
+	if options.json:
+		result = {
+			'ipAddresses': ipAddresses,
+			'restricted': bool([report for report in reports if report.restricted]),
+			'checks': dict((report.name, report.toDict()) for report in reports),
+		}
+		if options.json == '-':
+			printFunc(json.dumps(result, indent=2, sort_keys=True))
+		else:
+			with open(options.json, 'w') as jsonFile:
+				json.dump(result, jsonFile, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+	main()